@@ -0,0 +1,307 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the save-to-export pipeline.
+
+Builds a synthetic tree of figures from the package's template.svg and runs
+Inkscape's stand-in (stub_inkscape.py) with a controllable delay, so results
+are reproducible on a headless machine. Exports use the backend given by
+--backend (inkscape by default, whatever the figures), set through the
+export configuration. Measured:
+
+* save_to_export:   latency from writing a figure to its PNG appearing,
+                    through Watcher and FigureFileSystemEventHandler
+* bulk_export:      throughput of exporting the whole tree (bulk_export)
+* ensure_watch:     round trip of a client's watch request to the daemon
+* edit_list:        time to build the `edit` picker list of the tree's root,
+                    and until its first candidate is streamed to the picker,
+                    from the figure index (whole tree) and by listing the top
+                    level only
+
+Results are written as JSON (see --output) to compare across commits:
+
+    python benchmarks/bench.py --figures 500 --output before.json
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+BENCHMARKS_DIR = Path(__file__).resolve().parent
+REPOSITORY_DIR = BENCHMARKS_DIR.parent
+sys.path.insert(0, str(REPOSITORY_DIR / 'src'))
+
+TEMPLATE_PATH = REPOSITORY_DIR / 'src' / 'inkscape_figure_manager' / \
+    'template.svg'
+STUB_INKSCAPE_PATH = BENCHMARKS_DIR / 'stub_inkscape.py'
+# seconds to wait for a PNG before counting a sample as lost
+EXPORT_TIMEOUT = 10
+
+
+def summarize(samples, unit='s'):
+    """
+    Returns summary statistics of samples (a list of numbers).
+    """
+    ordered = sorted(samples)
+    return {
+        'unit': unit,
+        'samples': len(ordered),
+        'mean': statistics.fmean(ordered) if ordered else None,
+        'median': statistics.median(ordered) if ordered else None,
+        'p90': ordered[int(0.9 * (len(ordered) - 1))] if ordered else None,
+        'min': ordered[0] if ordered else None,
+        'max': ordered[-1] if ordered else None,
+    }
+
+
+def build_tree(root, figure_count, depth):
+    """
+    Writes figure_count figures copied from the template into root, spread
+    over directories nested `depth` levels deep. Returns their paths.
+    """
+    figures = []
+    for i in range(figure_count):
+        directory = Path(root)
+        for level in range(depth):
+            directory = directory / f"d{level}-{i % (level + 2)}"
+        directory.mkdir(parents=True, exist_ok=True)
+        figure = directory / f"figure-{i}.svg"
+        shutil.copy(TEMPLATE_PATH, figure)
+        figures.append(figure)
+    return figures
+
+
+def install_stub_inkscape(bin_dir):
+    """
+    Puts the stub first on PATH under the name `inkscape`.
+    """
+    bin_dir.mkdir(exist_ok=True)
+    (bin_dir / 'inkscape').symlink_to(STUB_INKSCAPE_PATH)
+    os.environ['PATH'] = f"{bin_dir}{os.pathsep}{os.environ['PATH']}"
+
+
+def write_export_config(config_dir, backend):
+    """
+    Writes an export configuration to config_dir selecting backend for every
+    figure. Returns config_dir.
+    """
+    from inkscape_figure_manager.export_config import GLOBAL_CONFIG_FILE_NAME
+
+    config_dir.mkdir()
+    (config_dir / GLOBAL_CONFIG_FILE_NAME).write_text(
+        json.dumps({'backend': backend}))
+    return config_dir
+
+
+def wait_for_export(png_path, previous_mtime):
+    deadline = time.monotonic() + EXPORT_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            if os.stat(png_path).st_mtime_ns != previous_mtime:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.001)
+    return False
+
+
+def bench_save_to_export(figures, iterations, config_dir):
+    from inkscape_figure_manager.export_config import ExportConfig
+    from inkscape_figure_manager.watcher import Watcher, export_path
+
+    watcher = Watcher(config=ExportConfig(config_dir))
+    root = Path(os.path.commonpath(figures))
+    watcher.watch(root)
+    samples = []
+    lost = 0
+    try:
+        for i in range(iterations):
+            figure = figures[i % len(figures)]
+            png = export_path(figure)
+            try:
+                previous_mtime = os.stat(png).st_mtime_ns
+            except OSError:
+                previous_mtime = None
+            start = time.monotonic()
+            with open(figure, 'a') as figure_file:
+                figure_file.write(f"<!-- save {i} -->\n")
+            if wait_for_export(png, previous_mtime):
+                samples.append(time.monotonic() - start)
+            else:
+                lost += 1
+    finally:
+        watcher.unwatch(root)
+        watcher.observer.stop()
+        watcher.shell_pool.close()
+    result = summarize(samples)
+    result['lost'] = lost
+    # exports per backend that ran them
+    result['backends'] = {
+        name[len('backend_'):]: count for name, count
+        in watcher.metrics.snapshot()['counters'].items()
+        if name.startswith('backend_')}
+    return result
+
+
+def bench_bulk_export(figures, jobs, config_dir):
+    from inkscape_figure_manager import bulk_export
+
+    start = time.monotonic()
+    results = list(bulk_export.export_figures(figures, jobs, config_dir))
+    elapsed = time.monotonic() - start
+    return {
+        'unit': 'figures/s',
+        'figures': len(figures),
+        'failed': sum(1 for _, succeeded in results if not succeeded),
+        'elapsed': elapsed,
+        'throughput': len(figures) / elapsed,
+    }
+
+
+def bench_ensure_watch(root, work_dir, iterations):
+    from inkscape_figure_manager import client
+    from inkscape_figure_manager.watcher_daemon import WatcherDaemon
+
+    # serve a private daemon instead of the user's
+    client.SOCKET_PATH = work_dir / 'daemon.sock'
+    daemon = WatcherDaemon(str(work_dir / 'pid'),
+                           config_dir=work_dir / 'daemon',
+                           socket_path=client.SOCKET_PATH)
+    # keep the daemon's startup messages out of the JSON on stdout
+    with contextlib.redirect_stdout(sys.stderr):
+        threading.Thread(target=daemon.work, daemon=True).start()
+        client.ping(timeout=10)
+
+    first = time.monotonic()
+    client.ensure_watch(root)
+    first = time.monotonic() - first
+
+    samples = []
+    for _ in range(iterations):
+        start = time.monotonic()
+        client.ensure_watch(root)
+        samples.append(time.monotonic() - start)
+    result = summarize(samples)
+    result['first_watch'] = first
+    return result
+
+
+def bench_edit_list(root, work_dir, iterations):
+    from inkscape_figure_manager import __main__ as cli
+    from inkscape_figure_manager.figure_index import (INDEX_FILE_NAME,
+                                                      FigureIndex)
+
+    def measure():
+        samples = []
+        first_samples = []
+        for _ in range(iterations):
+            start = time.monotonic()
+            figures = cli.iter_figures(root)
+            next(figures, None)
+            first_samples.append(time.monotonic() - start)
+            list(figures)
+            samples.append(time.monotonic() - start)
+        result = summarize(samples)
+        result['first_candidate'] = summarize(first_samples)
+        return result
+
+    cli.APP_USER_CONFIG_DIR = work_dir / 'cli'
+    cli.APP_USER_CONFIG_DIR.mkdir()
+    # without an index only the top-level directory is globbed
+    glob_result = measure()
+
+    index = FigureIndex(cli.APP_USER_CONFIG_DIR / INDEX_FILE_NAME)
+    index.index_tree(root)
+    index.close()
+    index_result = measure()
+    return {'glob_top_level': glob_result, 'index_tree': index_result}
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_DIR, check=True,
+            capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--figures', type=int, default=200,
+                        help="number of figures in the synthetic tree")
+    parser.add_argument('--depth', type=int, default=3,
+                        help="nesting depth of the synthetic tree")
+    parser.add_argument('--iterations', type=int, default=20,
+                        help="samples per latency benchmark")
+    parser.add_argument('--inkscape-delay', type=float, default=0.05,
+                        help="seconds the stub inkscape takes per export")
+    parser.add_argument('--inkscape-startup', type=float, default=0.5,
+                        help="seconds the stub inkscape takes to start")
+    parser.add_argument('--backend', default='inkscape',
+                        choices=['inkscape', 'raster', 'auto'],
+                        help="export backend of every figure")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(),
+                        help="processes used by the bulk export")
+    parser.add_argument('--only', action='append',
+                        choices=['save_to_export', 'bulk_export',
+                                 'ensure_watch', 'edit_list'],
+                        help="run only this benchmark (repeatable)")
+    parser.add_argument('--output', type=Path,
+                        help="write the JSON results here instead of stdout")
+    args = parser.parse_args()
+
+    os.environ['STUB_INKSCAPE_DELAY'] = str(args.inkscape_delay)
+    os.environ['STUB_INKSCAPE_STARTUP'] = str(args.inkscape_startup)
+    selected = set(args.only or ['save_to_export', 'bulk_export',
+                                 'ensure_watch', 'edit_list'])
+
+    with tempfile.TemporaryDirectory(prefix='figure-bench-') as work_dir:
+        work_dir = Path(work_dir)
+        install_stub_inkscape(work_dir / 'bin')
+        root = work_dir / 'figures'
+        figures = build_tree(root, args.figures, args.depth)
+        config_dir = write_export_config(work_dir / 'config', args.backend)
+
+        results = {}
+        if 'bulk_export' in selected:
+            results['bulk_export'] = bench_bulk_export(figures, args.jobs,
+                                                       config_dir)
+        if 'save_to_export' in selected:
+            results['save_to_export'] = bench_save_to_export(
+                figures, args.iterations, config_dir)
+        if 'edit_list' in selected:
+            results['edit_list'] = bench_edit_list(root, work_dir,
+                                                   args.iterations)
+        if 'ensure_watch' in selected:
+            results['ensure_watch'] = bench_ensure_watch(root, work_dir,
+                                                         args.iterations)
+
+    report = {
+        'revision': git_revision(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'parameters': {key: value for key, value in vars(args).items()
+                       if key not in ('output', 'only')},
+        'results': results,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        args.output.write_text(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
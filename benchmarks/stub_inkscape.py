@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+A stand-in for `inkscape` used by the benchmarks on machines without Inkscape.
+
+Supports the two ways the figure manager calls Inkscape:
+
+* `inkscape FIGURE --export-filename=OUTPUT ...` (or `--export-type=EXT`)
+* `inkscape --shell`, reading `;`-separated actions from stdin
+
+Every export sleeps STUB_INKSCAPE_DELAY seconds (default 0) and writes a
+small placeholder file. STUB_INKSCAPE_STARTUP seconds (default 0) are slept
+on startup to model Inkscape's launch cost.
+"""
+
+import os
+import sys
+import time
+
+PROMPT = "> "
+PLACEHOLDER = b"\x89PNG\r\n\x1a\nstub"
+
+
+def delay(env_var):
+    time.sleep(float(os.environ.get(env_var, 0)))
+
+
+def export(output_path):
+    delay('STUB_INKSCAPE_DELAY')
+    with open(output_path, 'wb') as output_file:
+        output_file.write(PLACEHOLDER)
+
+
+def shell():
+    sys.stdout.write("Inkscape interactive shell mode.\n" + PROMPT)
+    sys.stdout.flush()
+    for line in sys.stdin:
+        line = line.strip()
+        if line == 'quit':
+            return
+        output_path = None
+        for action in line.split(';'):
+            action = action.strip()
+            if action.startswith('export-filename:'):
+                output_path = action.split(':', 1)[1]
+            elif action == 'export-do' and output_path is not None:
+                export(output_path)
+        sys.stdout.write(PROMPT)
+        sys.stdout.flush()
+
+
+def main(args):
+    delay('STUB_INKSCAPE_STARTUP')
+    if '--shell' in args:
+        shell()
+        return
+    figure = next(arg for arg in args if arg.endswith('.svg'))
+    extension = 'png'
+    output_path = None
+    for arg in args:
+        if arg.startswith('--export-type='):
+            extension = arg.split('=', 1)[1]
+        elif arg.startswith('--export-filename='):
+            output_path = arg.split('=', 1)[1]
+    export(output_path or os.path.splitext(figure)[0] + '.' + extension)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
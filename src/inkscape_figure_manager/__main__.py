@@ -1,20 +1,28 @@
 #!/usr/bin/env python3
 
+import fcntl
+import itertools
+import json
 import logging
 import os
 import subprocess
 import sys
+import time
 import warnings
 from pathlib import Path
 from shutil import copy
-import re
 
 import click
 from appdirs import user_config_dir
 
-from inkscape_figure_manager import picker
-from inkscape_figure_manager.watcher import EXPORT_EXTENSTION_NO_DOT, Watcher
-from inkscape_figure_manager.watcher_daemon import WatcherDaemon
+# Only light modules are imported here; modules pulling in the daemon's
+# dependencies (watchdog, psutil, asyncio, sqlite3, ...) are imported where
+# they are used, since editors invoke the CLI on every action.
+from inkscape_figure_manager import client, picker
+from inkscape_figure_manager.client import DAEMON_DIR
+from inkscape_figure_manager.ignore import find_git_root
+from inkscape_figure_manager.references import (EXPORTED_SUFFIX,
+                                                 find_figure_references)
 
 APPLICATION_NAME = "inkscape-figure-manager"
 # os-agnostic path to current user's configuration directory for this
@@ -26,6 +34,23 @@ ERROR_CODE_CREATED_FILE_ALREADY_EXISTS = 1
 ERROR_CODE_EDIT_UNHANDLED_FILETYPE = 2
 ERROR_CODE_GIT_REPO_DNE = 3
 ERROR_CODE_BAD_DIR_TO_WATCH = 4
+ERROR_CODE_EXPORT_FAILED = 5
+ERROR_CODE_DAEMON_UNAVAILABLE = 6
+# opt-in daemon instrumentation; paths of a JSON-lines export trace and of the
+# cProfile statistics of exports
+TRACE_FILE_ENV_VAR = "INKSCAPE_FIGURE_MANAGER_TRACE"
+PROFILE_FILE_ENV_VAR = "INKSCAPE_FIGURE_MANAGER_PROFILE"
+# seconds without requests and exports after which the daemon exits; it is
+# started again by the next command. Unset or 0 keeps it running.
+IDLE_TIMEOUT_ENV_VAR = "INKSCAPE_FIGURE_MANAGER_IDLE_TIMEOUT"
+# 'native', 'polling' or 'auto' (default): how the daemon watches directories
+WATCH_BACKEND_ENV_VAR = "INKSCAPE_FIGURE_MANAGER_WATCH_BACKEND"
+# number of worker processes the watched roots are spread over; unset or 1
+# watches every root in the daemon process itself
+SHARDS_ENV_VAR = "INKSCAPE_FIGURE_MANAGER_SHARDS"
+# seconds to wait for a daemon that stopped serving (e.g. after its idle
+# timeout) to exit before starting a new one
+DAEMON_EXIT_TIMEOUT = 10
 
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 log = logging.getLogger('inkscape-figures')
@@ -36,6 +61,14 @@ def eprint(*args, **kwargs):
     print(*args, file=sys.stderr, **kwargs)
 
 
+def warn_not_watched():
+    """
+    Warns that figures being created or edited will not be exported on save.
+    """
+    eprint("The watcher daemon could not be reached; the figure will not be "
+           "exported when saved.")
+
+
 def snake_case(string):
     """
     Returns the snake case form of the passed string. Spaces and
@@ -54,15 +87,16 @@ def markdown_include_image_text(image_alternate_text, image_path):
     return rf"![{image_alternate_text}]({image_path})"
 
 
-def open_inkscape(open_file_path):
+def open_inkscape(*open_file_paths):
     """
-    Starts the Inkscape application opening the 'open_file_path'.
+    Starts the Inkscape application opening every path in 'open_file_paths'
+    (in one instance).
     """
     with warnings.catch_warnings():
         # leaving a subprocess running after interpreter exit raises a
         # warning in Python3.7+
         warnings.simplefilter("ignore", ResourceWarning)
-        subprocess.Popen(['inkscape', str(open_file_path)])
+        subprocess.Popen(['inkscape', *map(str, open_file_paths)])
 
 
 @click.group()
@@ -76,17 +110,22 @@ def cli():
 
 @cli.command()
 @click.option('-g', '--git', is_flag=True, default=False, show_default=True,
-              help="Watch the git repository. Searches from WATCHED_DIR")
+              help="Watch the git repository. Searches from WATCHED_DIR. "
+                   "Directories ignored by git are not watched.")
 @click.argument('watched_dir', default=Path.cwd())
 def watch(git, watched_dir):
     """
     Watches a directory and its subdirectories (recursive) for changes to
     figure files (*.svg); exports the figure (*.png) when this occurs.
 
+    With --git, directories matched by the repository's .gitignore files,
+    .git/info/exclude or a .figureignore file in the repository root are
+    skipped, and new directories are watched as they appear.
+
     WATCHED_DIR: directory to watch
     """
     if git:
-        watched_dir = Watcher.find_git_root(watched_dir)
+        watched_dir = find_git_root(watched_dir)
         if watched_dir is None:
             eprint("WATCHED_DIR is not within a git repository")
             sys.exit(ERROR_CODE_GIT_REPO_DNE)
@@ -94,7 +133,173 @@ def watch(git, watched_dir):
         if not Path(watched_dir).is_dir():
             eprint("WATCHED_DIR is not an existing directory")
             sys.exit(ERROR_CODE_BAD_DIR_TO_WATCH)
-    WatcherDaemon.ensure_watch(watched_dir)
+    if not client.ensure_watch(watched_dir, scoped=git):
+        eprint("The watcher daemon could not be reached.")
+        sys.exit(ERROR_CODE_DAEMON_UNAVAILABLE)
+
+
+@cli.command()
+@click.argument('watched_dir', default=Path.cwd())
+def unwatch(watched_dir):
+    """
+    Stops watching a directory previously passed to `watch` (or implicitly
+    watched by `create` and `edit`).
+
+    WATCHED_DIR: directory to stop watching
+    """
+    if not client.ensure_unwatch(watched_dir):
+        eprint("The watcher daemon could not be reached.")
+        sys.exit(ERROR_CODE_DAEMON_UNAVAILABLE)
+
+
+@cli.command()
+@click.argument('figure',
+                type=click.Path(exists=False, file_okay=True, dir_okay=False))
+def documents(figure):
+    """
+    Lists the indexed markdown documents that include a figure, i.e. the
+    documents to rebuild when it changes. Only documents within watched
+    directories are indexed.
+
+    FIGURE: path to the figure (*.svg) or its export
+    """
+    figure = Path(figure).absolute().with_suffix('.svg')
+    index = open_figure_index()
+    if index is None:
+        return
+    for document in index.documents_including(figure):
+        print(document)
+    index.close()
+
+
+@cli.command()
+@click.option('--json', 'as_json', is_flag=True, default=False,
+              help="Print the raw statistics as JSON.")
+def stats(as_json):
+    """
+    Prints the watcher daemon's statistics: export counters, queue depth and
+    latency histograms (debounce wait, export runtime and save-to-export).
+
+    Set INKSCAPE_FIGURE_MANAGER_TRACE to a file path before the daemon starts
+    to record every export as a JSON line, and INKSCAPE_FIGURE_MANAGER_PROFILE
+    to profile exports with cProfile (written when statistics are queried).
+
+    Errors: If the daemon cannot be reached, exit with non-zero return code.
+    """
+    daemon_stats = client.stats()
+    if daemon_stats is None:
+        eprint("The watcher daemon could not be reached.")
+        sys.exit(ERROR_CODE_DAEMON_UNAVAILABLE)
+    if as_json:
+        print(json.dumps(daemon_stats, indent=2))
+        return
+
+    print(f"uptime: {daemon_stats['uptime']:.0f}s")
+    for name, value in sorted({**daemon_stats['counters'],
+                               **daemon_stats['gauges']}.items()):
+        print(f"{name}: {value}")
+    for name, histogram in sorted(daemon_stats['histograms'].items()):
+        print(f"{name}: count={histogram['count']} "
+              f"mean={histogram['mean']:.3f}s p50<={histogram['p50']:.3f}s "
+              f"p90<={histogram['p90']:.3f}s p99<={histogram['p99']:.3f}s "
+              f"max={histogram['max']:.3f}s")
+
+
+@cli.command()
+@click.option('--json', 'as_json', is_flag=True, default=False,
+              help="Print every event as a line of JSON.")
+@click.argument('paths', nargs=-1,
+                type=click.Path(exists=False, file_okay=True, dir_okay=True))
+def subscribe(as_json, paths):
+    """
+    Prints export events as the watcher daemon produces them: an export
+    started, or its outcome (exported, skipped, cancelled or failed) with its
+    outputs. Runs until interrupted; editor integrations read the JSON lines
+    to refresh previews once a figure's outputs are written.
+
+    PATHS: figures or directories whose figures to report (default: all)
+
+    Errors: If the daemon cannot be reached or goes away, exit with non-zero
+    return code.
+    """
+    try:
+        events = client.subscribe(*paths)
+    except client.DaemonUnavailableError:
+        eprint("The watcher daemon could not be reached.")
+        sys.exit(ERROR_CODE_DAEMON_UNAVAILABLE)
+    try:
+        for event in events:
+            if as_json:
+                print(json.dumps(event), flush=True)
+                continue
+            stages = event['stages']
+            line = f"{event['event']} {event['figure']}"
+            if event['event'] == 'exported':
+                line += (f" -> {', '.join(event.get('outputs', []))} "
+                         f"({stages['finished'] - stages['received']:.2f}s)")
+            elif event['event'] == 'failed':
+                line += f": {event.get('error')}"
+            print(line, flush=True)
+    except KeyboardInterrupt:
+        return
+    eprint("The connection to the watcher daemon was lost.")
+    sys.exit(ERROR_CODE_DAEMON_UNAVAILABLE)
+
+
+@cli.command('export-all')
+@click.option('-g', '--git', is_flag=True, default=False, show_default=True,
+              help="Export the git repository. Searches from ROOT_DIR")
+@click.option('-f', '--force', is_flag=True, default=False, show_default=True,
+              help="Export figures even if their export is up to date.")
+@click.option('-j', '--jobs', type=click.IntRange(min=1),
+              default=os.cpu_count(), show_default=True,
+              help="Number of export processes.")
+@click.argument('root_dir', default=Path.cwd())
+def export_all(git, force, jobs, root_dir):
+    """
+    Exports every figure (*.svg) within a directory and its subdirectories
+    (recursive). Figures whose export is newer than the figure are skipped.
+
+    ROOT_DIR: directory to export
+
+    Errors:   If any export fails, exit with non-zero return code.
+    """
+    if git:
+        root_dir = find_git_root(root_dir)
+        if root_dir is None:
+            eprint("ROOT_DIR is not within a git repository")
+            sys.exit(ERROR_CODE_GIT_REPO_DNE)
+    elif not Path(root_dir).is_dir():
+        eprint("ROOT_DIR is not an existing directory")
+        sys.exit(ERROR_CODE_BAD_DIR_TO_WATCH)
+
+    from inkscape_figure_manager import bulk_export
+    from inkscape_figure_manager.export_config import ExportConfig
+
+    figures = list(bulk_export.find_figures(root_dir))
+    if not force:
+        config = ExportConfig(APP_USER_CONFIG_DIR)
+        figures = [figure for figure in figures
+                   if not bulk_export.is_up_to_date(figure, config)]
+    if not figures:
+        print("All figures are up to date.")
+        return
+
+    failed = []
+    start = time.monotonic()
+    for done, (figure, succeeded) in enumerate(
+            bulk_export.export_figures(figures, jobs, APP_USER_CONFIG_DIR),
+            start=1):
+        if not succeeded:
+            failed.append(figure)
+        eprint(f"[{done}/{len(figures)}] "
+               f"{'exported' if succeeded else 'FAILED'} {figure}")
+    elapsed = max(time.monotonic() - start, 1e-6)
+
+    print(f"Exported {len(figures) - len(failed)} of {len(figures)} figures "
+          f"in {elapsed:.1f}s ({len(figures) / elapsed:.1f} figures/s)")
+    if failed:
+        sys.exit(ERROR_CODE_EXPORT_FAILED)
 
 
 @cli.command()
@@ -119,6 +324,8 @@ def create(alternate_text, figure_dir, relative_from):
 
     Errors:             On existing figure, exit with non-zero return code.
     """
+    from inkscape_figure_manager.watcher import EXPORT_EXTENSTION_NO_DOT
+
     # Normalize input
     name = alternate_text.strip().replace(' ', '-').lower()
     figure_file_name = name + '.svg'
@@ -151,11 +358,58 @@ def create(alternate_text, figure_dir, relative_from):
     # Create and return inclusion text
     copy(str(TEMPLATE_FILE_PATH), str(absolute_figure))
     open_inkscape(absolute_figure)
-    WatcherDaemon.ensure_watch(figure_dir)
+    if not client.ensure_watch(figure_dir):
+        warn_not_watched()
     print(markdown_include_image_text(alternate_text,
                                       relative_figure_exported))
 
 
+@cli.command('create-missing')
+@click.option('-o', '--open', 'open_figures', is_flag=True, default=False,
+              show_default=True,
+              help="Open the created figures in Inkscape.")
+@click.argument('markdown',
+                type=click.Path(exists=True, file_okay=True, dir_okay=False))
+def create_missing(open_figures, markdown):
+    """
+    Creates every figure included by a markdown document that does not exist
+    yet, e.g. after writing `![..](figures/plot.png)` placeholders, and
+    watches their directories. Included images that exist (e.g. screenshots
+    without a figure) are left alone.
+
+    MARKDOWN: the markdown document
+    """
+    document_dir = Path(markdown).resolve().parent
+    template = TEMPLATE_FILE_PATH.read_bytes()
+
+    created = []
+    for figure in find_figure_references(markdown):
+        # '..' would make the daemon think the directory is already watched
+        figure_path = Path(os.path.normpath(document_dir / figure))
+        # an existing image would be overwritten by the template's export
+        if figure_path.exists() or \
+                figure_path.with_suffix(EXPORTED_SUFFIX).exists():
+            continue
+        figure_path.parent.mkdir(parents=True, exist_ok=True)
+        try:
+            with open(figure_path, 'xb') as figure_file:
+                figure_file.write(template)
+        except FileExistsError:
+            # created since we checked
+            continue
+        created.append(figure_path)
+        print(os.path.relpath(figure_path))
+
+    if not created:
+        print("No missing figures")
+        return
+    if not client.ensure_watch(*sorted({figure.parent
+                                        for figure in created})):
+        warn_not_watched()
+    if open_figures:
+        open_inkscape(*created)
+
+
 @cli.command()
 @click.argument(
     'path',
@@ -174,7 +428,8 @@ def edit(ctx, path):
             Directory:      Edit a figure within the directory
                             (use the picker if there is more than one)
     """
-    path = Path(path).absolute()
+    # the figure index holds normalized paths ('..' resolved)
+    path = Path(os.path.abspath(path))
 
     selected_file = None
     while path.is_file():
@@ -182,13 +437,7 @@ def edit(ctx, path):
             selected_file = path
             break
         if str(path).endswith('.md'):
-            # PARSE file for figures
-            markdown_file = open(str(path), "r")
-            markdown_content = markdown_file.read()
-            figures = re.findall("!\[.*?\]\((.*?)\.png\)", markdown_content)
-            for i in range(len(figures)):
-                figures[i] = figures[i] + ".svg"
-
+            figures = markdown_figures(path)
             returncode, index = picker.pick(figures)
             if returncode != 0:
                 print("Picker returned with non-zero exit status.")
@@ -196,37 +445,92 @@ def edit(ctx, path):
             if index is ValueError:
                 print("A value error occurred while choosing with the picker.")
                 return
-            selected_file = str(path.parent) + "/" + figures[index]
+            selected_file = path.parent / figures[index]
             break
         eprint("Error: file is neither markdown nor figure.\n"
             "Try 'python -m inkscape_figure_manager edit --help' for help.")
         sys.exit(ERROR_CODE_EDIT_UNHANDLED_FILETYPE)
 
     if path.is_dir():
-        # Find svg files and sort them
-        files = path.glob('*.svg')
-        files = sorted(files, key=lambda f: f.stat().st_mtime, reverse=True)
+        # Find svg files sorted by most recently modified
+        figures = iter_figures(path)
+        first_figures = list(itertools.islice(figures, 2))
 
         # if there is only one figure in the directory select it
-        if len(files) == 1:
-            selected_file = files[0]
+        if len(first_figures) == 1:
+            selected_file = first_figures[0][0]
             print(selected_file)
-        # otherwise launch the picker for selection
+        # otherwise launch the picker while the rest are still listed
         else:
-            names = [f.stem for f in files]
-            returncode, index = picker.pick(names)
+            returncode, selected_file = picker.pick_value(
+                itertools.chain(first_figures, figures))
             if returncode != 0:
                 print("Picker returned with non-zero exit status.")
                 return
-            if index is ValueError:
+            if selected_file is ValueError:
                 print("A value error occurred while choosing with the picker.")
                 return
-            selected_file = files[index]
 
-    WatcherDaemon.ensure_watch(Path(selected_file).parent)
+    if not client.ensure_watch(Path(selected_file).parent):
+        warn_not_watched()
     open_inkscape(selected_file)
 
 
+def open_figure_index():
+    """
+    Returns the daemon's FigureIndex, or None if it does not exist yet.
+    """
+    from inkscape_figure_manager.figure_index import (INDEX_FILE_NAME,
+                                                      FigureIndex)
+    return FigureIndex.open_existing(APP_USER_CONFIG_DIR / INDEX_FILE_NAME)
+
+
+def markdown_figures(markdown_path):
+    """
+    Returns the figures (*.svg paths relative to the document) included by the
+    markdown document at markdown_path. Uses the figure index as a cache when
+    it exists.
+    """
+    index = open_figure_index()
+    if index is None:
+        return find_figure_references(markdown_path)
+    figures = index.document_figures(markdown_path)
+    index.close()
+    return [os.path.relpath(figure, markdown_path.parent) for figure in figures]
+
+
+def iter_figures(directory):
+    """
+    Yields (file, name) of the figures to pick from in directory, most
+    recently modified first. If the directory is watched, the daemon's figure
+    index lists the whole tree below it without touching the file system, as
+    the rows are read; otherwise only the directory itself is listed.
+    """
+    directory = Path(os.path.abspath(directory))
+    index = open_figure_index()
+    if index is not None and index.covers(directory):
+        try:
+            for figure_path, title in index.iter_figures_under(directory):
+                figure_path = Path(figure_path)
+                name = str(figure_path.relative_to(directory).with_suffix(''))
+                yield figure_path, f"{name} ({title})" if title else name
+        finally:
+            index.close()
+        return
+    if index is not None:
+        index.close()
+
+    figures = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.endswith('.svg') and entry.is_file():
+                figures.append((entry.stat().st_mtime_ns, entry.path))
+    figures.sort(reverse=True)
+    for _, figure_path in figures:
+        figure_path = Path(figure_path)
+        yield figure_path, figure_path.stem
+
+
 def ensure_init():
     """
     Ensures the configuration directories and a figure template exist.
@@ -241,18 +545,111 @@ def ensure_init():
              str(TEMPLATE_FILE_PATH))
 
 
+def _absolute_env_path(env_var):
+    """
+    Returns the absolute form of the path in env_var, or None if unset. The
+    daemon changes its working directory, so relative paths would break.
+    """
+    path = os.environ.get(env_var)
+    return None if not path else os.path.abspath(path)
+
+
+def _idle_timeout():
+    """
+    Returns the daemon's idle timeout in seconds, or None if unset or invalid.
+    """
+    idle_timeout = os.environ.get(IDLE_TIMEOUT_ENV_VAR)
+    if not idle_timeout:
+        return None
+    try:
+        return max(float(idle_timeout), 0) or None
+    except ValueError:
+        log.warning("ignoring invalid %s: %r"
+                    % (IDLE_TIMEOUT_ENV_VAR, idle_timeout))
+        return None
+
+
+def _watch_backend():
+    """
+    Returns the daemon's watch backend (see Watcher), 'auto' if unset or
+    invalid.
+    """
+    watch_backend = os.environ.get(WATCH_BACKEND_ENV_VAR) or 'auto'
+    if watch_backend not in ('auto', 'native', 'polling'):
+        log.warning("ignoring invalid %s: %r"
+                    % (WATCH_BACKEND_ENV_VAR, watch_backend))
+        return 'auto'
+    return watch_backend
+
+
+def _shards():
+    """
+    Returns the number of daemon worker processes, 1 if unset or invalid.
+    """
+    shards = os.environ.get(SHARDS_ENV_VAR)
+    if not shards:
+        return 1
+    try:
+        return max(1, int(shards))
+    except ValueError:
+        log.warning("ignoring invalid %s: %r" % (SHARDS_ENV_VAR, shards))
+        return 1
+
+
+def wait_for_daemon_exit():
+    """
+    Waits for a daemon that no longer serves but still runs, e.g. one saving
+    its state after its idle timeout, to exit; while its pidfile exists,
+    starting a new daemon does nothing.
+    """
+    import psutil
+
+    try:
+        pid = int((DAEMON_DIR / 'pid').read_text().strip())
+    except (OSError, ValueError):
+        return
+    deadline = time.monotonic() + DAEMON_EXIT_TIMEOUT
+    while psutil.pid_exists(pid) and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
 def ensure_watcher_daemon():
     """
-    Ensures the watcher daemon (server) is running
+    Ensures the watcher daemon (server) is running. A running daemon costs a
+    single socket round trip; otherwise it is started under a lock so
+    concurrent clients start only one.
     """
-    daemon_dir = Path(f"/var/run/user/{os.getuid()}/inkscape-figure-managerd")
-    if not daemon_dir.exists():
-        daemon_dir.mkdir()
-    watcher_daemon = WatcherDaemon(
-        pidfile=f"{daemon_dir}/pid",
-        stdout=f"{daemon_dir}/stdout",
-        stderr=f"{daemon_dir}/stderr")
-    watcher_daemon.start()
+    if client.ping():
+        return
+    if not DAEMON_DIR.exists():
+        DAEMON_DIR.mkdir()
+    with open(DAEMON_DIR / 'lock', 'w') as lock_file:
+        # a POSIX lock is not inherited by the forked daemon
+        fcntl.lockf(lock_file, fcntl.LOCK_EX)
+        if client.ping():
+            # another client started it while we waited for the lock
+            return
+        wait_for_daemon_exit()
+        from inkscape_figure_manager.watcher_daemon import (WatcherDaemon,
+                                                            WatcherSupervisor)
+
+        options = dict(
+            pidfile=f"{DAEMON_DIR}/pid",
+            stdout=f"{DAEMON_DIR}/stdout",
+            stderr=f"{DAEMON_DIR}/stderr",
+            config_dir=APP_USER_CONFIG_DIR,
+            trace_path=_absolute_env_path(TRACE_FILE_ENV_VAR),
+            profile_path=_absolute_env_path(PROFILE_FILE_ENV_VAR),
+            idle_timeout=_idle_timeout(),
+            watch_backend=_watch_backend())
+        shards = _shards()
+        if shards > 1:
+            watcher_daemon = WatcherSupervisor(shards=shards, **options)
+        else:
+            watcher_daemon = WatcherDaemon(**options)
+        watcher_daemon.start()
+        # hold the lock until the daemon serves requests
+        client.ping(timeout=client.TIMEOUT)
 
 
 if __name__ == '__main__':
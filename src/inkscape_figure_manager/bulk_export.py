@@ -0,0 +1,90 @@
+"""
+Export every figure in a directory tree across a pool of processes.
+
+Each worker process keeps its own export backends (see export_backends.py),
+including a persistent Inkscape shell, so a bulk export pays Inkscape's
+startup cost at most once per core rather than once per figure.
+"""
+
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from inkscape_figure_manager.export_backends import (ExportBackendError,
+                                                     ExportBackends)
+from inkscape_figure_manager.export_config import ExportConfig
+from inkscape_figure_manager.png_optimizer import optimize_png
+
+log = logging.getLogger('inkscape-figures')
+
+# the worker process's export backends; created by _init_worker
+_backends = None
+
+
+def find_figures(root):
+    """
+    Yields the path of every figure (*.svg) under root, skipping hidden
+    directories (e.g. '.git').
+    """
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = [d for d in dir_names if not d.startswith('.')]
+        for file_name in file_names:
+            if file_name.endswith('.svg'):
+                yield os.path.join(dir_path, file_name)
+
+
+def is_up_to_date(figure_path, config):
+    """
+    Returns True if every output of the figure's export profile (according to
+    the ExportConfig config) exists and is newer than the figure.
+    """
+    figure_mtime = os.stat(figure_path).st_mtime_ns
+    for output in config.outputs(figure_path):
+        try:
+            if os.stat(output.path).st_mtime_ns < figure_mtime:
+                return False
+        except OSError:
+            return False
+    return True
+
+
+def _init_worker(config_dir):
+    global _backends
+    _backends = ExportBackends(ExportConfig(config_dir))
+
+
+def _export(figure_path):
+    """
+    Exports one figure in a worker process. Returns (figure_path, succeeded).
+    """
+    settings = _backends.config.for_figure(figure_path)
+    outputs = _backends.config.outputs(figure_path, settings)
+    try:
+        _backends.export(figure_path, outputs, settings)
+    except ExportBackendError:
+        return figure_path, False
+    if settings['optimize']:
+        # already off the interactive path; optimize in the worker
+        for output in outputs:
+            if output.type != 'png':
+                continue
+            try:
+                optimize_png(output.path, settings['optimize_palette'])
+            except Exception as e:
+                log.warning("could not optimize %s: %s" % (output.path, e))
+    return figure_path, True
+
+
+def export_figures(figure_paths, jobs=None, config_dir=None):
+    """
+    Exports figure_paths using `jobs` processes (default: number of cores).
+    config_dir holds the user's export configuration (see export_config.py).
+    Yields (figure_path, succeeded) as each export completes.
+    """
+    jobs = jobs or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_worker,
+                             initargs=(config_dir,)) as executor:
+        futures = [executor.submit(_export, figure_path)
+                   for figure_path in figure_paths]
+        for future in as_completed(futures):
+            yield future.result()
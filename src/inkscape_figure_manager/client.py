@@ -0,0 +1,206 @@
+"""
+Client side of the watcher daemon's socket protocol.
+
+Clients (the CLI and editor integrations) import only this module, which
+depends on the standard library alone, so talking to the daemon does not pay
+for importing the daemon's dependencies (watchdog, psutil, asyncio, ...).
+
+Messages are newline-delimited JSON objects. Each request names a `command`
+and the daemon answers every request with one response holding `ok` and, on
+failure, `error`. A client may send any number of requests over one
+connection, except after a `subscribe` request: the daemon then writes one
+line per export event (see subscribe) to that connection until it closes.
+"""
+
+import json
+import os
+import socket
+import time
+from pathlib import Path
+
+# per-user runtime directory holding the daemon's pid file, logs and socket
+DAEMON_DIR = Path(f"/var/run/user/{os.getuid()}/inkscape-figure-managerd")
+SOCKET_PATH = DAEMON_DIR / 'socket'
+
+# seconds a client keeps trying to reach the daemon
+TIMEOUT = 4
+# seconds a client waits for the response to a request the daemon accepted;
+# e.g. a watch request walks whole trees
+RESPONSE_TIMEOUT = 300
+# first and maximum delay between connection attempts
+BACKOFF_START = 0.01
+BACKOFF_MAX = 0.5
+
+
+class DaemonUnavailableError(Exception):
+    """
+    Raised when the watcher daemon cannot be reached.
+    """
+
+
+def _retry(attempt, timeout):
+    """
+    Returns the result of attempt(deadline), retrying with exponential backoff
+    while it raises OSError or returns None. Raises DaemonUnavailableError
+    once `timeout` seconds pass; a timeout of 0 makes a single attempt.
+    """
+    if timeout is None:
+        timeout = TIMEOUT
+    deadline = time.monotonic() + timeout
+    delay = BACKOFF_START
+    while True:
+        try:
+            result = attempt(deadline)
+            if result is not None:
+                return result
+        except OSError:
+            pass
+        if time.monotonic() + delay > deadline:
+            raise DaemonUnavailableError(
+                f"no watcher daemon listening on {SOCKET_PATH}")
+        time.sleep(delay)
+        delay = min(delay * 2, BACKOFF_MAX)
+
+
+def _connect(deadline, response_timeout=RESPONSE_TIMEOUT):
+    """
+    Returns a socket connected to the daemon, with response_timeout set for
+    what follows. Only connecting is bound by the deadline.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(max(deadline - time.monotonic(), 1))
+        sock.connect(str(SOCKET_PATH))
+    except OSError:
+        sock.close()
+        raise
+    sock.settimeout(response_timeout)
+    return sock
+
+
+def request(message, timeout=None, response_timeout=RESPONSE_TIMEOUT):
+    """
+    Sends message (a dict) to the daemon and returns its response (a dict).
+    Reconnects with exponential backoff until `timeout` seconds pass, then
+    raises DaemonUnavailableError. A timeout of 0 makes a single attempt.
+    Once connected, waits up to response_timeout seconds for the response.
+    """
+    def attempt(deadline):
+        with _connect(deadline, response_timeout) as sock:
+            sock.sendall(json.dumps(message).encode() + b'\n')
+            with sock.makefile('rb') as sock_file:
+                try:
+                    response = sock_file.readline()
+                except socket.timeout:
+                    # sending the request again would not make it faster
+                    raise DaemonUnavailableError(
+                        f"no response from the watcher daemon within "
+                        f"{response_timeout}s")
+        return json.loads(response) if response else None
+
+    return _retry(attempt, timeout)
+
+
+def ping(timeout=0):
+    """
+    Returns True if the daemon answers within timeout seconds.
+    """
+    try:
+        return request({'command': 'ping'}, timeout,
+                       response_timeout=TIMEOUT).get('ok', False)
+    except DaemonUnavailableError:
+        return False
+
+
+def _absolute_paths(paths):
+    """
+    Returns paths made absolute and normalized; the daemon compares paths as
+    strings, so 'doc/../figures' must become 'figures'.
+    """
+    return [os.path.abspath(path) for path in paths]
+
+
+def ensure_watch(*paths, scoped=False):
+    """
+    Instructs the daemon to ensure it is watching every path in `paths`. If
+    scoped, directories ignored by the project are skipped (see
+    Watcher.watch). Returns False if the daemon could not be reached.
+    """
+    try:
+        response = request({
+            'command': 'watch',
+            'paths': _absolute_paths(paths),
+            'scoped': scoped,
+        })
+    except DaemonUnavailableError:
+        return False
+    return response.get('ok', False)
+
+
+def ensure_unwatch(*paths):
+    """
+    Instructs the daemon to stop watching every path in `paths`; directories
+    below them that were requested separately keep being watched. Returns
+    False if the daemon could not be reached.
+    """
+    try:
+        response = request({
+            'command': 'unwatch',
+            'paths': _absolute_paths(paths),
+        })
+    except DaemonUnavailableError:
+        return False
+    return response.get('ok', False)
+
+
+def stats():
+    """
+    Returns the daemon's metrics (see Metrics.snapshot), or None if the
+    daemon could not be reached.
+    """
+    try:
+        response = request({'command': 'stats'})
+    except DaemonUnavailableError:
+        return None
+    return response.get('stats')
+
+
+def subscribe(*paths, timeout=None):
+    """
+    Subscribes to the daemon's export events of the figures in `paths` and of
+    the figures below directories in `paths` (of every figure if no path is
+    given). Returns an iterator over the events (dicts, see
+    Metrics.add_listener) that ends when the daemon closes the connection.
+    Raises DaemonUnavailableError if the daemon cannot be reached.
+    """
+    def attempt(deadline):
+        sock = _connect(deadline)
+        try:
+            sock.sendall(json.dumps({
+                'command': 'subscribe',
+                'paths': _absolute_paths(paths),
+            }).encode() + b'\n')
+            sock_file = sock.makefile('rb')
+            response = sock_file.readline()
+        except OSError:
+            sock.close()
+            raise
+        if not response or not json.loads(response).get('ok', False):
+            sock_file.close()
+            sock.close()
+            return None
+        # events may be hours apart
+        sock.settimeout(None)
+        return sock, sock_file
+
+    sock, sock_file = _retry(attempt, timeout)
+    return _events(sock, sock_file)
+
+
+def _events(sock, sock_file):
+    with sock, sock_file:
+        try:
+            for line in sock_file:
+                yield json.loads(line)
+        except OSError:
+            pass
@@ -5,8 +5,6 @@ import sys
 import time
 from signal import SIGTERM
 
-import psutil
-
 
 class Daemon:
     """
@@ -70,6 +68,9 @@ class Daemon:
 
         # start doing work
         self.work()
+        # never return into the caller's code from the daemon process
+        self.delpid()
+        sys.exit(0)
 
     def delpid(self):
         try:
@@ -79,23 +80,27 @@ class Daemon:
 
     def start(self):
         """
-        Start the daemon
+        Start the daemon, unless one is already running
         """
+        # only the (rare) start path pays for importing psutil
+        import psutil
+
         # Check for a pidfile and see if the daemon already runs with that pid
         try:
             pf = open(self.pidfile, 'r')
             pid = int(pf.read().strip())
             pf.close()
             # search for processes
-            if pid not in psutil.pids():
+            if not psutil.pid_exists(pid):
                 # delete the pidfile
                 self.delpid()
             else:
                 # another daemon is already running
                 sys.stderr.write("A PID-file and respective process exist. "
                                  "Likely a running daemon. Exiting...\n")
+                return
 
-        except IOError:
+        except (IOError, ValueError):
             pid = None
 
         # Start the daemon
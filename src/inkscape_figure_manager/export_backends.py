@@ -0,0 +1,317 @@
+"""
+Backends exporting figures to images.
+
+* inkscape: renders with Inkscape, through a persistent shell (see
+            inkscape_shell.py) or a one-off process. Renders everything.
+* raster:   renders in-process with CairoSVG (optional dependency). Skips
+            Inkscape's startup entirely, but cannot render every feature
+            (e.g. filters or flowed text) or export the drawing area; such
+            figures fall back to Inkscape.
+
+Every backend produces all outputs of a figure's export profile (see
+ExportConfig.outputs) from a single load of the figure. Exports take an
+optional `cancel` threading.Event; setting it stops the export (killing
+Inkscape) and raises ExportCancelledError.
+
+The backend of each figure is chosen by the `backend` setting of the export
+configuration (see export_config.py):
+
+* auto:     raster if installed and able to render the figure, else inkscape
+* raster:   raster, falling back to inkscape only if it fails
+* inkscape: inkscape only
+"""
+
+import logging
+import os
+import re
+import subprocess
+import tempfile
+import threading
+
+from inkscape_figure_manager.export_config import ExportConfig
+from inkscape_figure_manager.inkscape_shell import (CANCEL_POLL_INTERVAL,
+                                                    ExportCancelledError,
+                                                    InkscapeShellError,
+                                                    InkscapeShellPool)
+
+log = logging.getLogger('inkscape-figures')
+
+# SVG features CairoSVG renders wrongly or not at all
+RASTER_UNSUPPORTED = re.compile(
+    rb'<(?:\w+:)?(?:filter|flowRoot|textPath|meshgradient|hatch|foreignObject'
+    rb'|switch)\b'
+    rb'|\bfilter\s*[:=]|shape-inside|inline-size|mix-blend-mode')
+# user units per inch in SVG and Inkscape
+CSS_DPI = 96
+# output types CairoSVG writes
+RASTER_TYPES = ('png', 'pdf', 'ps', 'eps')
+# Inkscape exports PNGs on the page color and opacity of the namedview, which
+# CairoSVG ignores
+_NAMEDVIEW_PATTERN = re.compile(rb'<sodipodi:namedview\b[^>]*>')
+_HEX_COLOR_PATTERN = re.compile(r'#([0-9a-fA-F]{3}|[0-9a-fA-F]{6})')
+
+
+def _attribute(element, name):
+    match = re.search(rb'\s' + re.escape(name) +
+                      rb'\s*=\s*(?:"([^"]*)"|\'([^\']*)\')', element)
+    if match is None:
+        return None
+    value = match.group(1)
+    if value is None:
+        value = match.group(2)
+    return value.decode(errors='replace').strip()
+
+
+def page_background(content):
+    """
+    Returns the background Inkscape exports the page of the SVG content (bytes)
+    on, as a CSS color, or None if it is transparent.
+    """
+    namedview = _NAMEDVIEW_PATTERN.search(content)
+    if namedview is None:
+        return None
+    try:
+        opacity = float(_attribute(namedview.group(),
+                                   b'inkscape:pageopacity') or 0)
+    except ValueError:
+        return None
+    if opacity <= 0:
+        return None
+    color = _attribute(namedview.group(), b'pagecolor') or '#ffffff'
+    hex_color = _HEX_COLOR_PATTERN.fullmatch(color)
+    if opacity >= 1 or hex_color is None:
+        return color
+    digits = hex_color.group(1)
+    if len(digits) == 3:
+        digits = ''.join(digit * 2 for digit in digits)
+    red, green, blue = (int(digits[i:i + 2], 16) for i in (0, 2, 4))
+    return f'rgba({red}, {green}, {blue}, {opacity:g})'
+
+
+class ExportBackendError(Exception):
+    """
+    Raised when a backend fails to export a figure.
+    """
+
+
+class InkscapeBackend:
+    name = 'inkscape'
+
+    def __init__(self, shell_pool=None):
+        self.shell_pool = shell_pool if shell_pool is not None \
+            else InkscapeShellPool()
+
+    def available(self):
+        return True
+
+    def can_export(self, figure_path, outputs):
+        return True
+
+    @staticmethod
+    def export_with_process(figure_path, output_path, dpi, area='page',
+                            export_type=None, cancel=None):
+        """
+        Exports the `area` ('page' or 'drawing') of figure_path to output_path
+        at dpi with a one-off Inkscape process. The type defaults to
+        output_path's suffix. Returns True if the export succeeded; raises
+        ExportCancelledError if cancel is set before the process exits.
+        """
+        command = [
+            'inkscape',
+            str(figure_path),
+            f'--export-area-{area}',
+            '--export-dpi', str(dpi),
+            f'--export-filename={output_path}',
+        ]
+        if export_type is not None:
+            command.append(f'--export-type={export_type}')
+        try:
+            process = subprocess.Popen(command)
+        except OSError as e:
+            log.error("could not run inkscape: %s" % e)
+            return False
+        while True:
+            try:
+                returncode = process.wait(
+                    None if cancel is None else CANCEL_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel.is_set():
+                    process.kill()
+                    process.wait()
+                    raise ExportCancelledError("export cancelled")
+        if returncode != 0:
+            log.error("the inkscape export subprocess exited with non-zero "
+                      "return code: %d" % returncode)
+            return False
+        return True
+
+    def export(self, figure_path, outputs, cancel=None):
+        """
+        Exports with the shell pool, falling back to one-off processes (one
+        per output) if the shell fails (e.g. an Inkscape without shell
+        actions).
+        """
+        try:
+            self.shell_pool.export(figure_path, outputs, cancel)
+            return
+        except InkscapeShellError as e:
+            log.warning("inkscape shell export of %s failed (%s); retrying "
+                        "with new inkscape processes" % (figure_path, e))
+        for output in outputs:
+            if not InkscapeBackend.export_with_process(
+                    figure_path, output.path, output.dpi, output.area,
+                    output.type, cancel):
+                raise ExportBackendError(f"inkscape failed to export "
+                                         f"{figure_path} to {output.path}")
+
+    def close(self):
+        self.shell_pool.close()
+
+
+class RasterBackend:
+    name = 'raster'
+
+    def __init__(self):
+        self._cairosvg = None
+        self._available = None
+        # exporting threads must not see a partially imported module
+        self._import_lock = threading.Lock()
+
+    def available(self):
+        """
+        Returns True if CairoSVG (and the cairo library) can be loaded. The
+        import is deferred to the first export as it is slow.
+        """
+        with self._import_lock:
+            if self._available is None:
+                try:
+                    import cairosvg
+                except (ImportError, OSError):
+                    self._available = False
+                else:
+                    self._cairosvg = cairosvg
+                    self._available = True
+            return self._available
+
+    def can_export(self, figure_path, outputs):
+        """
+        Returns False if the figure uses features this backend cannot render,
+        or an output needs a type or area it cannot export.
+        """
+        if any(output.type not in RASTER_TYPES or output.area != 'page'
+               for output in outputs):
+            return False
+        try:
+            with open(figure_path, 'rb') as figure_file:
+                content = figure_file.read()
+        except OSError:
+            return False
+        return RASTER_UNSUPPORTED.search(content) is None
+
+    def export(self, figure_path, outputs, cancel=None):
+        """
+        Renders the page of figure_path to every output. Files are written
+        atomically so readers never see a partial image. A render cannot be
+        interrupted; cancel is checked between outputs.
+        """
+        if not self.available():
+            raise ExportBackendError("cairosvg is not installed")
+        try:
+            with open(figure_path, 'rb') as figure_file:
+                content = figure_file.read()
+        except OSError as e:
+            raise ExportBackendError(str(e)) from e
+        background = page_background(content)
+        for output in outputs:
+            if cancel is not None and cancel.is_set():
+                raise ExportCancelledError("export cancelled")
+            self._render(figure_path, content, output, background)
+
+    def _render(self, figure_path, content, output, background=None):
+        output_dir = os.path.dirname(os.path.abspath(output.path))
+        fd, temporary_path = tempfile.mkstemp(dir=output_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as output_file:
+                convert = getattr(self._cairosvg, f'svg2{output.type}')
+                # Inkscape scales user units (1/96 in) with the export dpi,
+                # CairoSVG only physical units: render at 96 dpi and scale.
+                # Vector outputs are not scaled.
+                scale = output.dpi / CSS_DPI if output.type == 'png' else 1
+                # like Inkscape, only bitmaps get the page background
+                convert(bytestring=content, write_to=output_file,
+                        dpi=CSS_DPI, scale=scale,
+                        url=os.path.abspath(figure_path),
+                        background_color=background
+                        if output.type == 'png' else None)
+            os.replace(temporary_path, output.path)
+        except Exception as e:
+            try:
+                os.unlink(temporary_path)
+            except OSError:
+                pass
+            raise ExportBackendError(f"cairosvg failed to export "
+                                     f"{figure_path}: {e}") from e
+
+    def close(self):
+        pass
+
+
+class ExportBackends:
+    """
+    Chooses a backend per figure and falls back to Inkscape when the chosen
+    backend cannot render the figure.
+    """
+
+    def __init__(self, config=None, shell_pool=None):
+        """
+        config is the ExportConfig selecting backends; shell_pool is the
+        InkscapeShellPool used by the inkscape backend.
+        """
+        self.config = config if config is not None else ExportConfig()
+        self.inkscape = InkscapeBackend(shell_pool)
+        self.raster = RasterBackend()
+
+    def candidates(self, figure_path, outputs, settings=None):
+        """
+        Returns the backends to try for exporting figure_path to outputs, in
+        order.
+        """
+        if settings is None:
+            settings = self.config.for_figure(figure_path)
+        policy = settings.get('backend', 'auto')
+        if policy not in ('auto', 'raster', 'inkscape'):
+            log.warning("unknown export backend %r for %s; using auto"
+                        % (policy, figure_path))
+            policy = 'auto'
+        if policy == 'inkscape' or not self.raster.available():
+            return [self.inkscape]
+        if policy == 'raster' or self.raster.can_export(figure_path, outputs):
+            return [self.raster, self.inkscape]
+        return [self.inkscape]
+
+    def export(self, figure_path, outputs=None, settings=None, cancel=None):
+        """
+        Exports figure_path to outputs (list of ExportOutput; default: those
+        of the figure's profile) and returns the name of the backend that
+        succeeded. Raises ExportBackendError if every candidate backend
+        failed, or ExportCancelledError if cancel was set.
+        """
+        if settings is None:
+            settings = self.config.for_figure(figure_path)
+        if outputs is None:
+            outputs = self.config.outputs(figure_path, settings)
+        errors = []
+        for backend in self.candidates(figure_path, outputs, settings):
+            try:
+                backend.export(figure_path, outputs, cancel)
+                return backend.name
+            except ExportBackendError as e:
+                log.warning("%s export of %s failed: %s"
+                            % (backend.name, figure_path, e))
+                errors.append(str(e))
+        raise ExportBackendError('; '.join(errors))
+
+    def close(self):
+        self.inkscape.close()
+        self.raster.close()
@@ -0,0 +1,170 @@
+"""
+Export configuration with per-directory and per-figure overrides.
+
+Settings are merged from, in increasing precedence:
+
+1. the defaults below,
+2. `export.json` in the user's configuration directory,
+3. `.figureexport.json` files in the figure's directory and its ancestors
+   (nearer directories win),
+4. the entry for the figure's file name under the `figures` key of those
+   directory files.
+
+Named profiles merge across these files (a nearer definition of the same name
+wins). A profile is the list of outputs produced from each figure; an output
+sets its `type` (file format), `dpi`, `area` (`page` or `drawing`) and `name`,
+a format string with the fields `stem` (the figure's file name without
+suffix), `type` and `dpi`, relative to the figure's directory.
+
+Example `.figureexport.json`:
+
+    {
+        "backend": "inkscape",
+        "profile": "print",
+        "profiles": {
+            "print": [
+                {"type": "pdf"},
+                {"type": "png", "dpi": 96, "name": "{stem}@1x.png"},
+                {"type": "png", "dpi": 300}
+            ]
+        },
+        "figures": {"plot.svg": {"backend": "raster", "profile": "default"}}
+    }
+"""
+
+import collections
+import logging
+import os
+from pathlib import Path
+
+from inkscape_figure_manager.fileutil import read_json
+
+log = logging.getLogger('inkscape-figures')
+
+GLOBAL_CONFIG_FILE_NAME = 'export.json'
+DIRECTORY_CONFIG_FILE_NAME = '.figureexport.json'
+
+EXPORT_AREAS = ('page', 'drawing')
+# settings of an output not given by its profile
+DEFAULT_OUTPUT = {
+    'type': 'png',
+    'dpi': 300,
+    'area': 'page',
+    'name': '{stem}.{type}',
+}
+DEFAULTS = {
+    # 'auto' uses the fastest backend able to render the figure
+    'backend': 'auto',
+    'profile': 'default',
+    'profiles': {'default': [{}]},
+    # losslessly optimize exported PNGs (see png_optimizer.py)
+    'optimize': False,
+    # let the optimizer reduce figures with few colors to a palette
+    'optimize_palette': True,
+}
+
+ExportOutput = collections.namedtuple('ExportOutput',
+                                      ['path', 'type', 'dpi', 'area'])
+
+
+def output_settings(outputs):
+    """
+    Returns outputs (list of ExportOutput) as the JSON-serializable settings
+    recorded in the export manifest.
+    """
+    return [{'path': str(output.path), 'type': output.type,
+             'dpi': output.dpi, 'area': output.area} for output in outputs]
+
+
+def _merge(settings, overrides):
+    for key, value in overrides.items():
+        if key == 'figures':
+            continue
+        if key == 'profiles' and isinstance(value, dict):
+            settings['profiles'] = {**settings['profiles'], **value}
+        else:
+            settings[key] = value
+
+
+class ExportConfig:
+    """
+    Resolves the export settings of figures. Configuration files are re-read
+    only when their mtime changes.
+    """
+
+    def __init__(self, config_dir=None):
+        self.config_dir = None if config_dir is None else Path(config_dir)
+        # config file path -> (mtime, parsed content)
+        self._cache = {}
+
+    def _read(self, path):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            self._cache.pop(path, None)
+            return {}
+        cached = self._cache.get(path)
+        if cached is None or cached[0] != mtime:
+            content = read_json(path, default={})
+            if not isinstance(content, dict):
+                content = {}
+            cached = (mtime, content)
+            self._cache[path] = cached
+        return cached[1]
+
+    def for_figure(self, figure_path):
+        """
+        Returns the merged settings (dict) of the figure at figure_path.
+        """
+        settings = dict(DEFAULTS)
+        if self.config_dir is not None:
+            _merge(settings, self._read(self.config_dir /
+                                        GLOBAL_CONFIG_FILE_NAME))
+
+        figure_path = Path(figure_path).absolute()
+        figure_settings = {}
+        for directory in reversed(figure_path.parents):
+            directory_config = self._read(directory /
+                                          DIRECTORY_CONFIG_FILE_NAME)
+            if not directory_config:
+                continue
+            _merge(settings, directory_config)
+            figure_settings.update(
+                directory_config.get('figures', {}).get(figure_path.name, {}))
+        _merge(settings, figure_settings)
+        return settings
+
+    def outputs(self, figure_path, settings=None):
+        """
+        Returns the outputs (list of ExportOutput) of the figure at
+        figure_path according to its profile. settings are the figure's
+        settings, resolved if not given.
+        """
+        if settings is None:
+            settings = self.for_figure(figure_path)
+        figure_path = Path(figure_path).absolute()
+        profile = settings['profiles'].get(settings['profile'])
+        if not profile:
+            log.warning("unknown export profile %r for %s; using default"
+                        % (settings['profile'], figure_path))
+            profile = DEFAULTS['profiles']['default']
+
+        outputs = []
+        for output in profile:
+            output = {**DEFAULT_OUTPUT, **output}
+            if output['area'] not in EXPORT_AREAS:
+                log.warning("unknown export area %r for %s; using page"
+                            % (output['area'], figure_path))
+                output['area'] = 'page'
+            try:
+                name = output['name'].format(stem=figure_path.stem,
+                                             type=output['type'],
+                                             dpi=output['dpi'])
+                dpi = int(output['dpi'])
+            except (KeyError, IndexError, ValueError) as e:
+                log.warning("invalid export output %r for %s: %s"
+                            % (output, figure_path, e))
+                continue
+            outputs.append(ExportOutput(figure_path.parent / name,
+                                        output['type'], dpi, output['area']))
+        return outputs
@@ -0,0 +1,347 @@
+"""
+On-disk index of the figures in watched directories.
+
+The watcher daemon keeps a SQLite database of every figure below its watched
+roots (path, mtime, size, title and the files it links) and of the markdown
+documents including them. Watcher events update it incrementally, so clients
+such as `edit` can list figures without walking the file system, and the
+watcher finds the figures to re-export when a linked file changes.
+"""
+
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+from inkscape_figure_manager.fileutil import walk_files
+from inkscape_figure_manager.references import find_figure_references
+from inkscape_figure_manager.svg_assets import find_assets
+
+INDEX_FILE_NAME = 'figures.sqlite3'
+# a figure's title is searched for in this many leading bytes
+_TITLE_SEARCH_SIZE = 1 << 16
+_TITLE_PATTERN = re.compile(rb"<title[^>]*>([^<]*)</title>")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS roots (
+    path TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS figures (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    title TEXT
+);
+CREATE INDEX IF NOT EXISTS figures_by_mtime ON figures (mtime_ns);
+CREATE TABLE IF NOT EXISTS documents (
+    path TEXT PRIMARY KEY,
+    mtime_ns INTEGER NOT NULL,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS figure_references (
+    document TEXT NOT NULL,
+    figure TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    PRIMARY KEY (document, position)
+);
+CREATE INDEX IF NOT EXISTS figure_references_by_figure
+    ON figure_references (figure);
+CREATE TABLE IF NOT EXISTS figure_assets (
+    figure TEXT NOT NULL,
+    asset TEXT NOT NULL,
+    PRIMARY KEY (figure, asset)
+);
+CREATE INDEX IF NOT EXISTS figure_assets_by_asset ON figure_assets (asset);
+"""
+# bumped when indexed figures must be re-read; 1 added figure_assets
+_SCHEMA_VERSION = 1
+
+
+def read_title(figure_path):
+    """
+    Returns the text of the figure's first <title> element, or None.
+    """
+    try:
+        with open(figure_path, 'rb') as figure_file:
+            head = figure_file.read(_TITLE_SEARCH_SIZE)
+    except OSError:
+        return None
+    match = _TITLE_PATTERN.search(head)
+    if match is None:
+        return None
+    return match.group(1).decode(errors='replace').strip() or None
+
+
+def _read_assets(figure_path):
+    try:
+        return find_assets(figure_path)
+    except OSError:
+        return []
+
+
+def _subtree_bounds(directory):
+    """
+    Returns (low, high) such that every path strictly below directory sorts
+    within [low, high). Lets range queries use the primary key index.
+    """
+    directory = os.path.abspath(directory).rstrip('/')
+    # '0' is the character following '/'
+    return directory + '/', directory + '0'
+
+
+class FigureIndex:
+    """
+    Thread-safe handle on the index database at `path`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(str(path), check_same_thread=False,
+                                           isolation_level=None)
+        # readers (clients) must not block on the daemon's writes
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        version = self._connection.execute(
+            "PRAGMA user_version").fetchone()[0]
+        self._connection.executescript(_SCHEMA)
+        if version < _SCHEMA_VERSION:
+            # re-read every figure on the next index_tree
+            self._connection.execute("UPDATE figures SET mtime_ns = -1")
+            self._connection.execute(
+                f"PRAGMA user_version = {_SCHEMA_VERSION}")
+
+    @classmethod
+    def open_existing(cls, path):
+        """
+        Returns the index at path, or None if the daemon never created one.
+        """
+        if not os.path.isfile(path):
+            return None
+        try:
+            return cls(path)
+        except sqlite3.Error:
+            return None
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    def covers(self, directory):
+        """
+        Returns True if directory is within an indexed root.
+        """
+        directory = Path(os.path.abspath(directory))
+        roots = {Path(row[0]) for row in self._execute("SELECT path FROM roots")}
+        return directory in roots or not roots.isdisjoint(directory.parents)
+
+    def update_figure(self, figure_path):
+        """
+        Indexes (or re-indexes) the figure at figure_path; removes it from the
+        index if it no longer exists.
+        """
+        try:
+            stat = os.stat(figure_path)
+        except OSError:
+            self.remove(figure_path)
+            return
+        self._store_figures([(str(figure_path), stat.st_mtime_ns,
+                              stat.st_size, read_title(figure_path))])
+
+    def _store_figures(self, figures):
+        """
+        Stores figures, (path, mtime, size, title) tuples, and the files they
+        link.
+        """
+        assets = [(figure[0], asset) for figure in figures
+                  for asset in _read_assets(figure[0])]
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO figures VALUES (?, ?, ?, ?)", figures)
+            self._connection.executemany(
+                "DELETE FROM figure_assets WHERE figure = ?",
+                [(figure[0],) for figure in figures])
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO figure_assets VALUES (?, ?)", assets)
+
+    def update_document(self, document_path):
+        """
+        Indexes the figures included by the markdown document at
+        document_path; removes it from the index if it no longer exists.
+        The document is only re-read if its size or mtime changed.
+        """
+        try:
+            self.document_figures(document_path)
+        except OSError:
+            self.remove(document_path)
+
+    def document_figures(self, document_path):
+        """
+        Returns the absolute paths of the figures included by the markdown
+        document at document_path, in order of appearance. Results are cached
+        in the index by the document's size and mtime.
+        """
+        document_path = str(document_path)
+        stat = os.stat(document_path)
+        cached = self._execute(
+            "SELECT mtime_ns, size FROM documents WHERE path = ?",
+            (document_path,))
+        if cached and tuple(cached[0]) == (stat.st_mtime_ns, stat.st_size):
+            return [row[0] for row in self._execute(
+                "SELECT figure FROM figure_references WHERE document = ? "
+                "ORDER BY position", (document_path,))]
+
+        parent = Path(document_path).parent
+        figures = [os.path.normpath(parent / figure)
+                   for figure in find_figure_references(document_path)]
+        self._store_document(document_path, stat, figures)
+        return figures
+
+    def _store_document(self, document_path, stat, figures):
+        """
+        Stores the document's figures (absolute paths) and its size and mtime.
+        """
+        document_path = str(document_path)
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            self._connection.execute(
+                "INSERT OR REPLACE INTO documents VALUES (?, ?, ?)",
+                (document_path, stat.st_mtime_ns, stat.st_size))
+            self._connection.execute(
+                "DELETE FROM figure_references WHERE document = ?",
+                (document_path,))
+            self._connection.executemany(
+                "INSERT INTO figure_references VALUES (?, ?, ?)",
+                [(document_path, figure, position)
+                 for position, figure in enumerate(figures)])
+
+    def remove(self, path):
+        """
+        Removes the figure or document at path, and anything indexed below it
+        if it was a directory.
+        """
+        path = str(path)
+        low, high = _subtree_bounds(path)
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            for table in ('figures', 'documents'):
+                self._connection.execute(
+                    f"DELETE FROM {table} "
+                    f"WHERE path = ? OR (path >= ? AND path < ?)",
+                    (path, low, high))
+            self._connection.execute(
+                "DELETE FROM figure_references "
+                "WHERE document = ? OR (document >= ? AND document < ?)",
+                (path, low, high))
+            self._connection.execute(
+                "DELETE FROM figure_assets "
+                "WHERE figure = ? OR (figure >= ? AND figure < ?)",
+                (path, low, high))
+
+    def index_tree(self, root, record_root=True, walk=None):
+        """
+        Brings the index of everything below root up to date and, if
+        record_root, records root as indexed. Files whose size and mtime are
+        unchanged are not re-read. walk optionally yields the directories to
+        index (see walk_files).
+        """
+        root = str(root)
+        low, high = _subtree_bounds(root)
+        known = {}
+        for table in ('figures', 'documents'):
+            known.update(
+                (path, (mtime_ns, size)) for path, mtime_ns, size in
+                self._execute(f"SELECT path, mtime_ns, size FROM {table} "
+                              f"WHERE path >= ? AND path < ?", (low, high)))
+
+        seen = set()
+        changed_figures = []
+        for dir_path, file_names in walk_files(root, walk):
+            for file_name in file_names:
+                if not file_name.endswith(('.svg', '.md')):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                seen.add(path)
+                if known.get(path) == (stat.st_mtime_ns, stat.st_size):
+                    continue
+                if file_name.endswith('.svg'):
+                    changed_figures.append((path, stat.st_mtime_ns,
+                                            stat.st_size, read_title(path)))
+                else:
+                    parent = Path(path).parent
+                    try:
+                        figures = [os.path.normpath(parent / figure) for figure
+                                   in find_figure_references(path)]
+                    except OSError:
+                        continue
+                    self._store_document(path, stat, figures)
+
+        self._store_figures(changed_figures)
+        with self._lock, self._connection:
+            self._connection.execute("BEGIN")
+            for path in known.keys() - seen:
+                self._connection.execute(
+                    "DELETE FROM figures WHERE path = ?", (path,))
+                self._connection.execute(
+                    "DELETE FROM figure_assets WHERE figure = ?", (path,))
+                self._connection.execute(
+                    "DELETE FROM documents WHERE path = ?", (path,))
+                self._connection.execute(
+                    "DELETE FROM figure_references WHERE document = ?",
+                    (path,))
+            if record_root:
+                self._connection.execute(
+                    "INSERT OR IGNORE INTO roots VALUES (?)", (root,))
+
+    def remove_root(self, root):
+        """
+        Stops treating root as indexed; its entries are kept so that watching
+        it again only re-reads changed files.
+        """
+        self._execute("DELETE FROM roots WHERE path = ?", (str(root),))
+
+    def iter_figures_under(self, directory, batch_size=256):
+        """
+        Yields (path, title) of every figure below directory (recursive), most
+        recently modified first. Rows are read in batches, so callers can use
+        the first figures before the rest are read.
+        """
+        low, high = _subtree_bounds(directory)
+        with self._lock:
+            cursor = self._connection.execute(
+                "SELECT path, title FROM figures WHERE path >= ? AND path < ? "
+                "ORDER BY mtime_ns DESC", (low, high))
+        while True:
+            with self._lock:
+                rows = cursor.fetchmany(batch_size)
+            if not rows:
+                return
+            yield from rows
+
+    def documents_including(self, figure_path):
+        """
+        Returns the markdown documents that include the figure at figure_path,
+        i.e. the documents to rebuild when it changes.
+        """
+        return [row[0] for row in self._execute(
+            "SELECT DISTINCT document FROM figure_references WHERE figure = ? "
+            "ORDER BY document", (os.path.normpath(figure_path),))]
+
+    def figures_using(self, asset_path):
+        """
+        Returns the figures linking the file at asset_path (see
+        svg_assets.py).
+        """
+        return [row[0] for row in self._execute(
+            "SELECT figure FROM figure_assets WHERE asset = ? ORDER BY figure",
+            (os.path.normpath(asset_path),))]
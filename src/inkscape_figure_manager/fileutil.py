@@ -0,0 +1,69 @@
+"""
+Small file system helpers shared by the daemon's persistent state.
+"""
+
+import json
+import os
+import tempfile
+from pathlib import Path
+
+
+def atomic_write_text(path, text):
+    """
+    Writes text to path atomically: readers see either the old or the new
+    content, never a partial write.
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=path.parent, prefix=f".{path.name}.")
+    try:
+        with os.fdopen(fd, 'w') as tmp_file:
+            tmp_file.write(text)
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+def atomic_write_json(path, data):
+    """
+    Atomically writes data to path as JSON.
+    """
+    atomic_write_text(path, json.dumps(data, indent=1, sort_keys=True))
+
+
+def walk_files(root, walk=None):
+    """
+    Yields (directory, file names) of root and every directory below it,
+    skipping hidden directories (e.g. '.git'). If given, walk() yields the
+    directories to list instead (e.g. IgnoreRules.walk of a scoped watch).
+    """
+    if walk is None:
+        for dir_path, dir_names, file_names in os.walk(root):
+            dir_names[:] = [d for d in dir_names if not d.startswith('.')]
+            yield dir_path, file_names
+        return
+    for directory in walk():
+        try:
+            with os.scandir(directory) as entries:
+                file_names = [entry.name for entry in entries
+                              if entry.is_file()]
+        except OSError:
+            continue
+        yield str(directory), file_names
+
+
+def read_json(path, default=None):
+    """
+    Returns the JSON content of path, or default if it is missing or corrupt.
+    """
+    try:
+        with open(path, 'r') as json_file:
+            return json.load(json_file)
+    except (OSError, ValueError):
+        return default
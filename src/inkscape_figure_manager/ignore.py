@@ -0,0 +1,175 @@
+"""
+Decide which directories of a project are worth watching.
+
+Rules are read from `.gitignore` files (in the project root and in any
+subdirectory, applying below the directory they are in), from
+`.git/info/exclude`, and from a project-level `.figureignore` file in the
+project root. All use the gitignore pattern syntax. A few directories that
+never hold figures are always excluded.
+"""
+
+import os
+import re
+from pathlib import Path
+
+PROJECT_IGNORE_FILE_NAME = '.figureignore'
+DEFAULT_EXCLUDES = ['.git/', 'node_modules/', '__pycache__/', '.venv/',
+                    '.tox/']
+
+
+def find_git_root(path):
+    """
+    Returns the directory containing the '.git/' of the repository holding
+    path, or None if path is not within a git repository.
+    """
+    path = Path(path).absolute()
+    for directory in (path, *path.parents):
+        if (directory / '.git').is_dir():
+            return directory
+    return None
+
+
+def _translate(pattern):
+    """
+    Returns the regex (string) matching a path relative to the pattern's base
+    directory, following gitignore's rules for anchoring and wildcards.
+    """
+    anchored = '/' in pattern
+    pattern = pattern.lstrip('/')
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('/**', i) and i + 3 == len(pattern):
+            regex += '/.*'
+            i += 3
+            continue
+        if char == '*':
+            regex += '[^/]*'
+        elif char == '?':
+            regex += '[^/]'
+        elif char == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                regex += re.escape(char)
+            else:
+                regex += '[' + pattern[i + 1:end].replace('!', '^', 1) + ']'
+                i = end
+        elif char == '\\' and i + 1 < len(pattern):
+            i += 1
+            regex += re.escape(pattern[i])
+        else:
+            regex += re.escape(char)
+        i += 1
+    if not anchored:
+        regex = '(?:.*/)?' + regex
+    return regex + '$'
+
+
+class _Rule:
+    __slots__ = ('regex', 'negated', 'directory_only')
+
+    def __init__(self, pattern):
+        self.negated = pattern.startswith('!')
+        if self.negated:
+            pattern = pattern[1:]
+        self.directory_only = pattern.endswith('/')
+        # a trailing slash does not make a pattern anchored
+        self.regex = re.compile(_translate(pattern.rstrip('/')))
+
+    def matches(self, relative_path, is_dir):
+        if self.directory_only and not is_dir:
+            return False
+        return self.regex.match(relative_path) is not None
+
+
+def _parse_rules(lines):
+    rules = []
+    for line in lines:
+        line = line.rstrip('\n')
+        if not line.strip() or line.startswith('#'):
+            continue
+        if not line.endswith('\\ '):
+            line = line.rstrip()
+        rules.append(_Rule(line))
+    return rules
+
+
+def _read_rules(path):
+    try:
+        with open(path, 'r', errors='replace') as rules_file:
+            return _parse_rules(rules_file)
+    except OSError:
+        return []
+
+
+class IgnoreRules:
+    """
+    The ignore rules of the project rooted at `root`.
+
+    Nested `.gitignore` files are loaded lazily by load_directory() as the
+    caller walks into directories.
+    """
+
+    def __init__(self, root):
+        self.root = Path(root)
+        root_rules = _parse_rules(DEFAULT_EXCLUDES)
+        root_rules += _read_rules(self.root / '.git' / 'info' / 'exclude')
+        root_rules += _read_rules(self.root / PROJECT_IGNORE_FILE_NAME)
+        # relative directory (posix string, '' for root) -> rules
+        self._rules = {'': root_rules}
+        self.load_directory(self.root)
+
+    def load_directory(self, directory):
+        """
+        Loads the `.gitignore` of directory, if any.
+        """
+        relative = self._relative(directory)
+        rules = _read_rules(Path(directory) / '.gitignore')
+        if rules:
+            self._rules[relative] = self._rules.get(relative, []) + rules
+
+    def _relative(self, path):
+        relative = Path(path).relative_to(self.root).as_posix()
+        return '' if relative == '.' else relative
+
+    def is_ignored(self, path, is_dir=True):
+        """
+        Returns True if the path (below root) is ignored. Later rules, and
+        rules from deeper `.gitignore` files, take precedence.
+        """
+        relative = self._relative(path)
+        ignored = False
+        parts = relative.split('/')
+        for depth in range(len(parts)):
+            base = '/'.join(parts[:depth])
+            for rule in self._rules.get(base, ()):
+                sub_path = relative[len(base) + 1:] if base else relative
+                if rule.matches(sub_path, is_dir):
+                    ignored = not rule.negated
+        return ignored
+
+    def walk(self, start=None):
+        """
+        Yields every directory below (and including) start (default: root)
+        that is not ignored, loading nested `.gitignore` files on the way.
+        """
+        stack = [self.root if start is None else Path(start)]
+        while stack:
+            directory = stack.pop()
+            yield directory
+            try:
+                entries = list(os.scandir(directory))
+            except OSError:
+                continue
+            for entry in entries:
+                if not entry.is_dir(follow_symlinks=False):
+                    continue
+                if self.is_ignored(entry.path):
+                    continue
+                self.load_directory(entry.path)
+                stack.append(Path(entry.path))
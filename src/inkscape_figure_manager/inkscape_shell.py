@@ -0,0 +1,219 @@
+"""
+Long-lived Inkscape processes for exporting figures.
+
+Starting Inkscape often takes longer than rendering a figure. Instead of
+launching `inkscape` per export, a pool of `inkscape --shell` processes is kept
+alive and export actions are written to their stdin. A worker that crashes or
+hangs is killed and respawned on its next job, and every worker is recycled
+after a fixed number of jobs to bound Inkscape's memory growth. An export can
+be cancelled while it runs, which kills its worker process.
+"""
+
+import logging
+import os
+import queue
+import select
+import subprocess
+import time
+
+log = logging.getLogger('inkscape-figures')
+
+# Inkscape writes this prompt after its banner and after every command
+SHELL_PROMPT = b"> "
+# recycle a worker after this many exports
+DEFAULT_MAX_JOBS = 100
+# seconds an export may take before the worker is considered hung
+DEFAULT_TIMEOUT = 60
+# seconds between checks for cancellation of a running export
+CANCEL_POLL_INTERVAL = 0.05
+
+
+class InkscapeShellError(Exception):
+    """
+    Raised when an Inkscape shell worker crashes, hangs or fails to export.
+    """
+
+
+class ExportCancelledError(Exception):
+    """
+    Raised when an export is cancelled (see the `cancel` arguments) before it
+    finished.
+    """
+
+
+def export_actions(figure_path, outputs):
+    """
+    Returns the Inkscape actions exporting figure_path to every output, from
+    a single load of the document. outputs are ExportOutput-like objects with
+    `path`, `type`, `dpi` and `area` ('page' or 'drawing').
+    """
+    actions = [f'file-open:{figure_path}']
+    for output in outputs:
+        actions += [
+            f'export-filename:{output.path}',
+            f'export-type:{output.type}',
+            f'export-area-{output.area}',
+            f'export-dpi:{output.dpi}',
+            'export-do',
+        ]
+    actions.append('file-close')
+    return actions
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+
+class InkscapeShellWorker:
+    """
+    A single `inkscape --shell` process. The process is started lazily and
+    restarted after a failure or after max_jobs commands.
+    """
+
+    def __init__(self, max_jobs=DEFAULT_MAX_JOBS, timeout=DEFAULT_TIMEOUT):
+        self.max_jobs = max_jobs
+        self.timeout = timeout
+        self._process = None
+        self._jobs = 0
+
+    def _spawn(self):
+        try:
+            self._process = subprocess.Popen(
+                ['inkscape', '--shell'],
+                stdin=subprocess.PIPE,
+                stdout=subprocess.PIPE,
+                bufsize=0,
+            )
+        except OSError as e:
+            raise InkscapeShellError(f"could not start inkscape: {e}") from e
+        self._jobs = 0
+        self._read_until_prompt()
+        log.debug("inkscape shell worker %d started" % self._process.pid)
+
+    def _read_until_prompt(self, cancel=None):
+        """
+        Reads the worker's stdout until the shell prompt appears. Kills the
+        worker and raises if it exits or does not prompt within the timeout,
+        or if cancel (a threading.Event) is set.
+        """
+        output = b""
+        deadline = time.monotonic() + self.timeout
+        stdout = self._process.stdout
+        while not output.endswith(SHELL_PROMPT):
+            if cancel is not None and cancel.is_set():
+                self.kill()
+                raise ExportCancelledError("export cancelled")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                self.close()
+                raise InkscapeShellError("inkscape shell timed out")
+            if cancel is not None:
+                remaining = min(remaining, CANCEL_POLL_INTERVAL)
+            readable, _, _ = select.select([stdout], [], [], remaining)
+            if not readable:
+                continue
+            chunk = os.read(stdout.fileno(), 4096)
+            if not chunk:
+                self.close()
+                raise InkscapeShellError("inkscape shell exited unexpectedly")
+            output += chunk
+        return output
+
+    def run(self, actions, cancel=None):
+        """
+        Runs the actions (list of strings) in the shell and waits for them to
+        finish. Setting cancel (a threading.Event) kills the worker and raises
+        ExportCancelledError.
+        """
+        if self._process is None or self._process.poll() is not None:
+            self._spawn()
+        try:
+            self._process.stdin.write((';'.join(actions) + '\n').encode())
+        except (BrokenPipeError, OSError) as e:
+            self.close()
+            raise InkscapeShellError(f"inkscape shell exited: {e}") from e
+        self._read_until_prompt(cancel)
+
+        self._jobs += 1
+        if self._jobs >= self.max_jobs:
+            self.close()
+
+    def close(self):
+        """
+        Stops the worker process; the next run() starts a new one.
+        """
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        if process.poll() is None:
+            try:
+                process.stdin.write(b"quit\n")
+                process.stdin.close()
+                process.wait(timeout=1)
+            except (OSError, subprocess.TimeoutExpired):
+                process.kill()
+                process.wait()
+
+    def kill(self):
+        """
+        Kills the worker process without waiting for its current command.
+        """
+        if self._process is None:
+            return
+        process, self._process = self._process, None
+        process.kill()
+        process.wait()
+
+
+class InkscapeShellPool:
+    """
+    A fixed-size pool of Inkscape shell workers. Workers start lazily, so an
+    idle pool costs no processes.
+    """
+
+    def __init__(self, size=1, max_jobs=DEFAULT_MAX_JOBS,
+                 timeout=DEFAULT_TIMEOUT):
+        self._workers = [InkscapeShellWorker(max_jobs, timeout)
+                         for _ in range(size)]
+        self._idle = queue.Queue()
+        for worker in self._workers:
+            self._idle.put(worker)
+
+    def export(self, figure_path, outputs, cancel=None):
+        """
+        Exports figure_path to every output (see export_actions) using an
+        idle worker; blocks until one is available. Raises InkscapeShellError
+        if any export failed, or ExportCancelledError if cancel (a
+        threading.Event) was set before the export finished.
+        """
+        figure_path = str(figure_path)
+        if ';' in figure_path or any(';' in str(output.path)
+                                     for output in outputs):
+            # actions are separated by ';' and cannot be escaped
+            raise InkscapeShellError("path contains ';'")
+
+        previous_mtimes = [_mtime(output.path) for output in outputs]
+        worker = self._idle.get()
+        try:
+            if cancel is not None and cancel.is_set():
+                raise ExportCancelledError("export cancelled")
+            worker.run(export_actions(figure_path, outputs), cancel)
+        finally:
+            self._idle.put(worker)
+
+        # the shell does not report failed actions; check the outputs instead
+        for output, previous_mtime in zip(outputs, previous_mtimes):
+            mtime = _mtime(output.path)
+            if mtime is None or mtime == previous_mtime:
+                raise InkscapeShellError(f"inkscape did not write "
+                                         f"{output.path}")
+
+    def close(self):
+        """
+        Stops every worker process.
+        """
+        for worker in self._workers:
+            worker.close()
@@ -0,0 +1,182 @@
+"""
+Persistent record of exported figures.
+
+The manifest maps each figure (*.svg) to the hash of its render-relevant
+content (see svg_canonical.py), the state of the files it links (see
+svg_assets.py), the export settings used and the outputs produced by its last
+successful export. It lets the daemon skip exports whose rendering cannot have
+changed (including saves that only changed Inkscape's view state) and find
+figures that went stale while it was not running.
+"""
+
+import json
+import logging
+import os
+import threading
+
+from inkscape_figure_manager.fileutil import (atomic_write_text, read_json,
+                                              walk_files)
+from inkscape_figure_manager.svg_assets import asset_signatures
+from inkscape_figure_manager.svg_canonical import render_hash
+
+log = logging.getLogger('inkscape-figures')
+
+MANIFEST_FILE_NAME = 'manifest.json'
+# seconds between a record and the save including it; records in between are
+# saved together
+SAVE_DELAY = 2
+
+
+def _assets_unchanged(assets):
+    for asset, signature in assets.items():
+        try:
+            stat = os.stat(asset)
+        except OSError:
+            current = None
+        else:
+            current = [stat.st_size, stat.st_mtime_ns]
+        if current != signature:
+            return False
+    return True
+
+
+class ExportManifest:
+    """
+    Thread-safe manifest persisted as JSON at `path`.
+
+    Each entry is keyed by the figure's absolute path and holds:
+        hash:       render hash of the figure (see render_hash)
+        size:       figure size when hashed
+        mtime_ns:   figure mtime when hashed
+        settings:   export settings used
+        outputs:    paths of the exported files
+        assets:     [size, mtime] (None if missing) of every linked file
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._entries = read_json(path, default={})
+        # serializes saves, so an older state is never written last
+        self._save_lock = threading.Lock()
+        # pending save (threading.Timer) scheduled by record
+        self._save_timer = None
+
+    def save(self):
+        """
+        Writes the manifest now. Writing happens outside the lock, so
+        concurrent checks and records are not blocked by it.
+        """
+        with self._save_lock:
+            with self._lock:
+                if self._save_timer is not None:
+                    self._save_timer.cancel()
+                    self._save_timer = None
+                text = json.dumps(self._entries, indent=1, sort_keys=True)
+            atomic_write_text(self.path, text)
+
+    def _schedule_save(self):
+        with self._lock:
+            if self._save_timer is not None:
+                return
+            self._save_timer = threading.Timer(SAVE_DELAY, self.save)
+            self._save_timer.daemon = True
+            self._save_timer.start()
+
+    def entry(self, figure_path):
+        with self._lock:
+            return self._entries.get(str(figure_path))
+
+    def check(self, figure_path, settings, output_paths):
+        """
+        Returns (current, content_hash). current is True if every path in
+        output_paths exists and was exported with settings from content that
+        renders like the figure's current content, and linked files that are
+        unchanged.
+        The figure is only hashed if its size or mtime changed since it was
+        recorded; content_hash is None when it was not hashed.
+        """
+        figure_path = str(figure_path)
+        entry = self.entry(figure_path)
+        output_paths = [str(output_path) for output_path in output_paths]
+        if not all(map(os.path.exists, output_paths)):
+            return False, None
+        stat = os.stat(figure_path)
+
+        if entry is None:
+            # never exported by us; trust the outputs if they are newer
+            current = all(os.stat(output_path).st_mtime_ns >= stat.st_mtime_ns
+                          for output_path in output_paths)
+            return current, None
+        if entry['settings'] != settings or \
+                entry.get('outputs') != output_paths:
+            return False, None
+        if not _assets_unchanged(entry.get('assets', {})):
+            return False, None
+        if (entry['size'], entry['mtime_ns']) == (stat.st_size,
+                                                  stat.st_mtime_ns):
+            return True, entry['hash']
+
+        content_hash = render_hash(figure_path)
+        if content_hash != entry['hash']:
+            return False, content_hash
+        # touched, or only its view state changed; remember the new mtime to
+        # avoid rehashing
+        with self._lock:
+            entry['size'] = stat.st_size
+            entry['mtime_ns'] = stat.st_mtime_ns
+        return True, content_hash
+
+    def record(self, figure_path, settings, output_paths, content_hash=None,
+               assets=None, signature=None):
+        """
+        Records a successful export of figure_path. The manifest is saved
+        within SAVE_DELAY seconds (or by save()).
+        signature is the figure's (size, mtime_ns) and content_hash its render
+        hash, and assets the signatures of its linked files (see
+        asset_signatures), all best taken before the export started: a save
+        during the export then shows as a change.
+        """
+        figure_path = str(figure_path)
+        if signature is None:
+            stat = os.stat(figure_path)
+            signature = (stat.st_size, stat.st_mtime_ns)
+        if content_hash is None:
+            content_hash = render_hash(figure_path)
+        if assets is None:
+            assets = asset_signatures(figure_path)
+        size, mtime_ns = signature
+        with self._lock:
+            self._entries[figure_path] = {
+                'hash': content_hash,
+                'size': size,
+                'mtime_ns': mtime_ns,
+                'settings': settings,
+                'outputs': [str(output_path) for output_path in output_paths],
+                'assets': assets,
+            }
+        self._schedule_save()
+
+    def forget(self, figure_path):
+        with self._lock:
+            self._entries.pop(str(figure_path), None)
+
+    def stale_figures(self, root, export_plan, walk=None):
+        """
+        Yields the figures under root whose outputs are missing or out of
+        date. export_plan maps a figure path to its export settings and
+        output paths. walk optionally yields the directories to search (see
+        walk_files).
+        """
+        for dir_path, file_names in walk_files(root, walk):
+            for file_name in file_names:
+                if not file_name.endswith('.svg'):
+                    continue
+                figure_path = os.path.join(dir_path, file_name)
+                try:
+                    current, _ = self.check(figure_path,
+                                            *export_plan(figure_path))
+                except OSError:
+                    continue
+                if not current:
+                    yield figure_path
@@ -0,0 +1,209 @@
+"""
+Counters, latency histograms and export spans for the watcher daemon.
+
+Every export queued by the watcher is traced as a span with the time of its
+first event, the time it settled (the end of the debounce wait), and the start
+and end of the export itself. Finished spans feed latency histograms and,
+optionally, a JSON-lines trace file. Clients read a snapshot with the `stats`
+command. Listeners (e.g. the daemon's subscriptions) receive an event when an
+export starts and when its span finishes.
+"""
+
+import cProfile
+import json
+import threading
+import time
+
+# upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, float('inf'))
+
+
+class Histogram:
+    """
+    A latency histogram with fixed buckets. Not thread-safe on its own.
+    """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """
+        Returns the upper bound of the bucket holding the q-quantile.
+        """
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.max,
+            'p50': self.quantile(0.5),
+            'p90': self.quantile(0.9),
+            'p99': self.quantile(0.99),
+        }
+
+
+class ExportSpan:
+    """
+    The timeline of one export. Stages are marked with mark() and the span is
+    closed with finish().
+    """
+
+    def __init__(self, metrics, figure_path, received=None):
+        self._metrics = metrics
+        self.figure_path = str(figure_path)
+        self.stages = {'received': received or time.time()}
+        self.details = {}
+
+    def mark(self, stage):
+        self.stages[stage] = time.time()
+        if stage == 'export_started':
+            self._metrics.notify(self, 'started')
+
+    def finish(self, outcome, **details):
+        """
+        Closes the span. outcome is 'exported', 'skipped', 'cancelled' or
+        'failed'.
+        """
+        self.mark('finished')
+        self.details.update(details)
+        self._metrics.finish_span(self, outcome)
+
+    def duration(self, start_stage, end_stage):
+        if start_stage in self.stages and end_stage in self.stages:
+            return self.stages[end_stage] - self.stages[start_stage]
+        return None
+
+
+class Metrics:
+    """
+    Thread-safe metrics registry.
+
+    trace_path is an optional JSON-lines file receiving every finished span.
+    profile_path opts into profiling exports with cProfile; the statistics are
+    written there by dump_profile().
+    """
+
+    # histogram name -> (start stage, end stage) of a span
+    SPAN_HISTOGRAMS = {
+        'debounce_wait': ('received', 'settled'),
+        'export_runtime': ('export_started', 'export_finished'),
+        'save_to_export': ('received', 'finished'),
+    }
+
+    def __init__(self, trace_path=None, profile_path=None):
+        self._lock = threading.Lock()
+        self.started = time.time()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self._trace_file = None
+        if trace_path is not None:
+            self._trace_file = open(trace_path, 'a', buffering=1)
+        self.profile_path = profile_path
+        self.profiler = cProfile.Profile() if profile_path else None
+        self._profile_lock = threading.Lock()
+        self._listeners = []
+
+    def add_listener(self, listener):
+        """
+        Calls listener with an event (a JSON-serializable dict) when an export
+        starts and when a span finishes. Events hold `event` ('started' or
+        the span's outcome), `figure`, the span's `stages` (timestamps) and
+        its details (e.g. `outputs`). Listeners are called on the exporting
+        thread and must not block.
+        """
+        self._listeners.append(listener)
+
+    def notify(self, span, event):
+        for listener in self._listeners:
+            listener({'event': event, 'figure': span.figure_path,
+                      'stages': dict(span.stages), **span.details})
+
+    def increment(self, name, amount=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def set_gauge(self, name, value):
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, value):
+        with self._lock:
+            self.histograms.setdefault(name, Histogram()).observe(value)
+
+    def start_span(self, figure_path, received=None):
+        return ExportSpan(self, figure_path, received)
+
+    def finish_span(self, span, outcome):
+        self.increment(f'exports_{outcome}')
+        for name, (start, end) in self.SPAN_HISTOGRAMS.items():
+            if name == 'save_to_export' and outcome != 'exported':
+                continue
+            duration = span.duration(start, end)
+            if duration is not None:
+                self.observe(name, duration)
+        if self._trace_file is not None:
+            record = {'figure': span.figure_path, 'outcome': outcome,
+                      'stages': span.stages, **span.details}
+            with self._lock:
+                self._trace_file.write(json.dumps(record) + '\n')
+        self.notify(span, outcome)
+
+    def profiled(self, function, *args):
+        """
+        Calls function(*args), under the profiler if profiling is enabled.
+        Profiled calls are serialized.
+        """
+        if self.profiler is None:
+            return function(*args)
+        # a profiler can only be active in one thread at a time
+        with self._profile_lock:
+            self.profiler.enable()
+            try:
+                return function(*args)
+            finally:
+                self.profiler.disable()
+
+    def dump_profile(self):
+        """
+        Writes the accumulated profile (pstats format) to profile_path.
+        """
+        if self.profiler is not None:
+            with self._profile_lock:
+                self.profiler.dump_stats(self.profile_path)
+
+    def snapshot(self):
+        """
+        Returns every metric as a JSON-serializable dict.
+        """
+        with self._lock:
+            return {
+                'uptime': time.time() - self.started,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'histograms': {name: histogram.snapshot() for name, histogram
+                               in self.histograms.items()},
+            }
@@ -0,0 +1,145 @@
+"""
+A trie of directories keyed on path components.
+
+The watcher daemon records every directory a client asks it to watch. Only
+the minimal set of them (directories without a requested ancestor) are
+watched, recursively, by watchdog; those are the trie's roots. Queries walk
+one node per path component, so they cost O(depth) regardless of how many
+directories are recorded.
+"""
+
+from pathlib import PurePath
+
+
+class _Node:
+    __slots__ = ('children', 'requested')
+
+    def __init__(self):
+        self.children = {}
+        self.requested = False
+
+
+class PathTrie:
+
+    def __init__(self):
+        self._root = _Node()
+
+    def _find(self, path):
+        node = self._root
+        for part in PurePath(path).parts:
+            node = node.children.get(part)
+            if node is None:
+                return None
+        return node
+
+    def __contains__(self, path):
+        node = self._find(path)
+        return node is not None and node.requested
+
+    def __iter__(self):
+        """
+        Yields every requested path.
+        """
+        stack = [(PurePath(name), child)
+                 for name, child in self._root.children.items()]
+        while stack:
+            current, node = stack.pop()
+            if node.requested:
+                yield current
+            stack.extend((current / name, child)
+                         for name, child in node.children.items())
+
+    def covered_by(self, path):
+        """
+        Returns the root covering path (path itself or its outermost requested
+        ancestor), or None if path is not covered.
+        """
+        node = self._root
+        current = PurePath()
+        for part in PurePath(path).parts:
+            node = node.children.get(part)
+            if node is None:
+                return None
+            current = current / part
+            if node.requested:
+                return current
+        return None
+
+    def covers(self, path):
+        """
+        Yields the requested directories strictly below path that are roots,
+        i.e. not covered by another requested directory below path.
+        """
+        node = self._find(path)
+        if node is not None:
+            yield from self._roots_below(node, PurePath(path))
+
+    def roots(self):
+        """
+        Returns the minimal set of requested directories covering all others.
+        """
+        return list(self._roots_below(self._root, PurePath()))
+
+    @staticmethod
+    def _roots_below(node, path):
+        """
+        Yields the outermost requested paths strictly below node (at path).
+        """
+        stack = [(path / name, child) for name, child in node.children.items()]
+        while stack:
+            current, node = stack.pop()
+            if node.requested:
+                yield current
+                continue
+            stack.extend((current / name, child)
+                         for name, child in node.children.items())
+
+    def add(self, path):
+        """
+        Records path as requested. Returns (promoted, demoted): promoted is
+        True if path became a root, demoted lists the roots it now covers.
+        Existing roots elsewhere in the trie are untouched.
+        """
+        path = PurePath(path)
+        if path in self:
+            return False, []
+        if self.covered_by(path) is not None:
+            self._insert(path)
+            return False, []
+        demoted = list(self.covers(path))
+        self._insert(path)
+        return True, demoted
+
+    def remove(self, path):
+        """
+        Forgets the requested path. Returns (demoted, promoted): demoted is
+        True if path was a root, promoted lists the requested directories
+        below it that became roots in its place.
+        """
+        path = PurePath(path)
+        if path not in self:
+            return False, []
+        was_root = self.covered_by(path) == path
+        self._find(path).requested = False
+        promoted = list(self.covers(path)) if was_root else []
+        self._prune(path)
+        return was_root, promoted
+
+    def _insert(self, path):
+        node = self._root
+        for part in path.parts:
+            node = node.children.setdefault(part, _Node())
+        node.requested = True
+
+    def _prune(self, path):
+        """
+        Removes the nodes of path that no longer lead to a requested path.
+        """
+        nodes = [self._root]
+        for part in path.parts:
+            nodes.append(nodes[-1].children[part])
+        for depth in range(len(path.parts), 0, -1):
+            node = nodes[depth]
+            if node.requested or node.children:
+                break
+            del nodes[depth - 1].children[path.parts[depth - 1]]
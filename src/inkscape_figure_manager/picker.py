@@ -5,9 +5,14 @@ Current supported matchers are:
 
 * rofi for Linux platforms
 * choose (https://github.com/chipsenkbeil/choose) on MacOS
+
+Options are streamed to the matcher as they are produced, so it appears
+before a long listing finishes. rofi reports the index of the selected line;
+choose reports its text, which is mapped back through a dictionary.
 """
 import platform
 import subprocess
+import threading
 
 SYSTEM_NAME = platform.system()
 
@@ -21,7 +26,7 @@ def get_picker_cmd(picker_args=None, fuzzy=True):
         args = ['rofi', '-sort', '-no-levenshtein-sort']
         if fuzzy:
             args += ['-matching', 'fuzzy']
-        args += ['-dmenu', '-p', "Select Figure", '-format', 's', '-i',
+        args += ['-dmenu', '-p', "Select Figure", '-format', 'i', '-i',
                  '-lines', '5']
     elif SYSTEM_NAME == "Darwin":
         args = ["choose"]
@@ -34,21 +39,73 @@ def get_picker_cmd(picker_args=None, fuzzy=True):
     return [str(arg) for arg in args]
 
 
-def pick(options, picker_args=None, fuzzy=True):
-    optionstr = '\n'.join(option.replace('\n', ' ') for option in options)
-    result = subprocess.run(
-        get_picker_cmd(picker_args=picker_args, fuzzy=fuzzy),
-        input=optionstr,
-        stdout=subprocess.PIPE,
-        check=False,
-        universal_newlines=True
-    )
-    returncode = result.returncode
-    selected = result.stdout.strip()
-
+def _feed(process, items, values, labels, stop):
+    """
+    Writes the label of every (value, label) in items to the picker's stdin,
+    recording values by line index and by label.
+    """
     try:
-        index = [opt.strip() for opt in options].index(selected)
-    except ValueError:
-        index = ValueError
+        for value, label in items:
+            if stop.is_set():
+                break
+            label = label.replace('\n', ' ')
+            values.append(value)
+            labels.setdefault(label.strip(), value)
+            process.stdin.write(label + '\n')
+            process.stdin.flush()
+    except (BrokenPipeError, OSError):
+        # the picker exited before reading every option
+        pass
+    finally:
+        try:
+            process.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+
+
+def pick_value(items, picker_args=None, fuzzy=True):
+    """
+    Lets the user pick from items, an iterable (e.g. a generator) of
+    (value, label) pairs consumed while the picker is open. Returns
+    (returncode, value); value is ValueError if nothing valid was picked.
+    """
+    command = get_picker_cmd(picker_args=picker_args, fuzzy=fuzzy)
+    process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE,
+                               universal_newlines=True)
+    # line index -> value, and label -> value
+    values = []
+    labels = {}
+    stop = threading.Event()
+    feeder = threading.Thread(target=_feed,
+                              args=(process, items, values, labels, stop),
+                              daemon=True)
+    feeder.start()
+    selected = process.stdout.read().strip()
+    returncode = process.wait()
+    # the selection was recorded before it was written; do not wait for the
+    # rest of a slow listing
+    stop.set()
+
+    # the last -format given (e.g. in picker_args) wins
+    formats = [command[i + 1] for i, arg in enumerate(command[:-1])
+               if arg == '-format']
+    if formats and formats[-1] == 'i':
+        try:
+            index = int(selected)
+        except ValueError:
+            return returncode, ValueError
+        # rofi reports -1 for text that matches no option
+        if not 0 <= index < len(values):
+            return returncode, ValueError
+        return returncode, values[index]
+    return returncode, labels.get(selected, ValueError)
+
 
-    return returncode, index
+def pick(options, picker_args=None, fuzzy=True):
+    """
+    Lets the user pick one of options (an iterable of strings). Returns
+    (returncode, index); index is ValueError if nothing valid was picked.
+    """
+    return pick_value(((index, option) for index, option
+                       in enumerate(options)), picker_args, fuzzy)
@@ -0,0 +1,246 @@
+"""
+Lossless optimization of exported PNGs.
+
+Inkscape writes RGBA PNGs compressed for speed; optimized, they take less
+room in repositories and load faster in rendered notes, without a single pixel
+changing. The first available optimizer is used:
+
+* oxipng or optipng (external tools), with palette reduction,
+* Pillow (optional dependency): recompression, and palette reduction of
+  images with at most 256 colors,
+* zlib: recompression of the image data only.
+
+The daemon optimizes on a background thread after the export finished (and
+runs external tools at a low CPU priority), so optimizing never delays a
+save's export. An optimized file replaces
+the original atomically, only if it is smaller and the original was not
+rewritten in the meantime.
+"""
+
+import functools
+import logging
+import os
+import queue
+import shutil
+import struct
+import subprocess
+import tempfile
+import threading
+import time
+import zlib
+
+from inkscape_figure_manager.metrics import Metrics
+
+log = logging.getLogger('inkscape-figures')
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+def _stat_signature(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def _nice(command):
+    """
+    Returns command run at a low CPU priority, if `nice` is available.
+    """
+    nice = shutil.which('nice')
+    return [nice, '-n', '10', *command] if nice else command
+
+
+def _optimize_with_oxipng(path, output_path, palette):
+    command = ['oxipng', '--opt', '2', '--strip', 'safe', '--quiet']
+    if not palette:
+        command += ['--nc', '--np']
+    subprocess.run(_nice(command + ['--out', output_path, path]), check=True)
+
+
+def _optimize_with_optipng(path, output_path, palette):
+    command = ['optipng', '-quiet', '-o2', '-clobber']
+    if not palette:
+        command += ['-nc', '-np']
+    subprocess.run(_nice(command + ['-out', output_path, path]), check=True)
+
+
+def _optimize_with_pillow(path, output_path, palette):
+    from PIL import Image
+
+    with Image.open(path) as image:
+        image.load()
+    dpi = image.info.get('dpi')
+    if palette and image.mode in ('RGB', 'RGBA') and \
+            image.getcolors(256) is not None:
+        reduced = image.quantize(colors=256,
+                                 method=Image.Quantize.FASTOCTREE)
+        # quantizing may merge colors; only keep an exact palette
+        if reduced.convert(image.mode).tobytes() == image.tobytes():
+            image = reduced
+    options = {'optimize': True}
+    if dpi is not None:
+        options['dpi'] = dpi
+    image.save(output_path, format='PNG', **options)
+
+
+def _recompress(path, output_path, palette):
+    """
+    Rewrites the PNG at path with its image data (IDAT) recompressed at the
+    highest zlib level. Other chunks are kept as they are.
+    """
+    with open(path, 'rb') as png_file:
+        data = png_file.read()
+    if not data.startswith(PNG_SIGNATURE):
+        raise ValueError(f"{path} is not a PNG")
+
+    chunks = []
+    image_data = []
+    position = len(PNG_SIGNATURE)
+    while position < len(data):
+        length, chunk_type = struct.unpack('>I4s', data[position:position + 8])
+        chunk_data = data[position + 8:position + 8 + length]
+        position += 12 + length
+        if chunk_type == b'IDAT':
+            if not image_data:
+                # the recompressed data takes the first IDAT's place
+                chunks.append((b'IDAT', None))
+            image_data.append(chunk_data)
+        else:
+            chunks.append((chunk_type, chunk_data))
+
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 15, 9)
+    compressed = compressor.compress(zlib.decompress(b''.join(image_data)))
+    compressed += compressor.flush()
+    with open(output_path, 'wb') as output_file:
+        output_file.write(PNG_SIGNATURE)
+        for chunk_type, chunk_data in chunks:
+            if chunk_data is None:
+                chunk_data = compressed
+            output_file.write(struct.pack('>I', len(chunk_data)))
+            output_file.write(chunk_type + chunk_data)
+            output_file.write(struct.pack(
+                '>I', zlib.crc32(chunk_type + chunk_data)))
+
+
+@functools.lru_cache(maxsize=1)
+def select_optimizer():
+    """
+    Returns (name, function) of the best optimizer available.
+    """
+    if shutil.which('oxipng'):
+        return 'oxipng', _optimize_with_oxipng
+    if shutil.which('optipng'):
+        return 'optipng', _optimize_with_optipng
+    try:
+        import PIL.Image  # noqa: F401
+    except ImportError:
+        return 'zlib', _recompress
+    return 'pillow', _optimize_with_pillow
+
+
+def optimize_png(path, palette=True):
+    """
+    Losslessly optimizes the PNG at path in place; palette allows reducing
+    images with few colors to a palette. Returns (size before, size after);
+    the sizes are equal if the file was left unchanged.
+    """
+    path = str(path)
+    signature = _stat_signature(path)
+    if signature is None:
+        raise FileNotFoundError(path)
+    size = signature[0]
+    name, optimize = select_optimizer()
+
+    directory, file_name = os.path.split(path)
+    fd, temporary_path = tempfile.mkstemp(dir=directory or '.',
+                                          prefix=f'.{file_name}.',
+                                          suffix='.tmp')
+    os.close(fd)
+    try:
+        optimize(path, temporary_path, palette)
+        optimized_size = os.path.getsize(temporary_path)
+        if optimized_size >= size:
+            return size, size
+        if _stat_signature(path) != signature:
+            # exported again while optimizing; the new file gets its own turn
+            return size, size
+        os.replace(temporary_path, path)
+        log.debug("%s optimized %s: %d -> %d bytes"
+                  % (name, path, size, optimized_size))
+        return size, optimized_size
+    finally:
+        try:
+            os.unlink(temporary_path)
+        except FileNotFoundError:
+            pass
+
+
+class PngOptimizer:
+    """
+    Optimizes PNGs on a background thread, recording the savings in metrics.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._queue = queue.Queue()
+        # submitted optimizations not finished yet
+        self._unfinished = 0
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def submit(self, png_path, palette=True):
+        """
+        Queues an optimization of the PNG at png_path (see optimize_png).
+        """
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True)
+                self._thread.start()
+            self._unfinished += 1
+        self._queue.put((str(png_path), palette))
+        self.metrics.set_gauge('png_optimize_queue_depth', self._queue.qsize())
+
+    @property
+    def idle(self):
+        """
+        True if no optimization is queued or running.
+        """
+        with self._lock:
+            return self._unfinished == 0
+
+    def stop(self):
+        """
+        Stops the worker thread after the queued optimizations.
+        """
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            self.metrics.set_gauge('png_optimize_queue_depth',
+                                   self._queue.qsize())
+            if job is None:
+                return
+            png_path, palette = job
+            start = time.monotonic()
+            try:
+                size, optimized_size = optimize_png(png_path, palette)
+            except Exception as e:
+                # e.g. a truncated PNG, or a failing external tool
+                log.warning("could not optimize %s: %s" % (png_path, e))
+                self.metrics.increment('png_optimize_failed')
+                continue
+            finally:
+                with self._lock:
+                    self._unfinished -= 1
+            self.metrics.observe('png_optimize_runtime',
+                                 time.monotonic() - start)
+            self.metrics.increment('png_optimized')
+            self.metrics.increment('png_bytes_before', size)
+            self.metrics.increment('png_bytes_saved', size - optimized_size)
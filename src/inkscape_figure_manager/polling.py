@@ -0,0 +1,311 @@
+"""
+Watch directories by polling, for file systems without working native events.
+
+Native (inotify) events are not delivered for changes made by other machines
+on network file systems (NFS, SMB, SSHFS) or by the host on some container
+bind mounts (9p, virtiofs, ...), so figures there would silently stop
+exporting. watchdog's generic polling observer lists the whole tree on every
+pass, which is too slow for large repositories.
+
+FigurePoller instead keeps the size and mtime of the figures and markdown
+documents under each polled root and, in one pass over every root:
+
+* lists (os.scandir) only the directories known to hold figures, and the
+  directories requested explicitly (e.g. just made by `create`),
+* every FULL_SCAN_INTERVAL seconds, walks the whole tree to find new
+  directories and documents.
+
+The poll interval drops to POLL_INTERVAL_MIN after a change and grows up to
+POLL_INTERVAL_MAX while nothing changes. Changes are dispatched to watchdog
+event handlers as watchdog events, so handlers work with either backend.
+
+Whether a directory needs polling is decided from its mount's file system
+type (mount_of) and, for other mounts, by checking that a probe file written
+there raises a native event (native_events_work).
+"""
+
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from watchdog.events import (FileCreatedEvent, FileDeletedEvent,
+                             FileModifiedEvent, FileSystemEventHandler)
+
+from inkscape_figure_manager.metrics import Metrics
+
+log = logging.getLogger('inkscape-figures')
+
+MOUNTS_PATH = '/proc/mounts'
+# file system types whose native events miss (remote) changes
+NETWORK_FILESYSTEMS = frozenset({
+    'nfs', 'nfs4', 'cifs', 'smbfs', 'smb3', 'afs', 'ceph', 'glusterfs',
+    'fuse.sshfs', 'fuse.rclone', 'fuse.gcsfuse', 'fuse.grpcfuse',
+    'fakeowner', '9p', 'virtiofs', 'vboxsf', 'vmhgfs', 'fuse.vmhgfs-fuse',
+    'prl_fs',
+})
+# seconds to wait for the native event of a probe file
+PROBE_TIMEOUT = 1
+# seconds between polls, right after a change and at most
+POLL_INTERVAL_MIN = 0.5
+POLL_INTERVAL_MAX = 5
+# growth of the poll interval per poll without changes
+POLL_BACKOFF = 1.5
+# seconds between walks of the whole tree of a polled root
+FULL_SCAN_INTERVAL = 60
+POLLED_SUFFIXES = ('.svg', '.md')
+
+
+def _unescape(field):
+    # /proc/mounts escapes whitespace and backslashes as octal
+    return re.sub(r'\\([0-7]{3})', lambda match: chr(int(match.group(1), 8)),
+                  field)
+
+
+def mount_of(path):
+    """
+    Returns (mount point, file system type) of the mount holding path, or None
+    if the mounts cannot be read (e.g. not on Linux).
+    """
+    path = os.path.realpath(path)
+    mount = None
+    try:
+        with open(MOUNTS_PATH) as mounts:
+            for line in mounts:
+                fields = line.split()
+                if len(fields) < 3:
+                    continue
+                mount_point = _unescape(fields[1])
+                if path != mount_point and \
+                        not path.startswith(mount_point.rstrip('/') + '/'):
+                    continue
+                # later mounts hide earlier ones on the same mount point
+                if mount is None or len(mount_point) >= len(mount[0]):
+                    mount = (mount_point, fields[2])
+    except OSError:
+        return None
+    return mount
+
+
+class _ProbeHandler(FileSystemEventHandler):
+
+    def __init__(self, probe_path):
+        super().__init__()
+        self.probe_path = probe_path
+        self.seen = threading.Event()
+
+    def on_any_event(self, event):
+        if event.src_path == self.probe_path:
+            self.seen.set()
+
+
+def native_events_work(observer, directory, timeout=PROBE_TIMEOUT):
+    """
+    Returns True if observer (a started watchdog observer) reports a file
+    written in directory within timeout seconds, False if it does not, and
+    None if no probe file can be written there.
+    """
+    try:
+        fd, probe_path = tempfile.mkstemp(
+            dir=directory, prefix='.inkscape-figure-manager-probe-')
+    except OSError:
+        return None
+    os.close(fd)
+    try:
+        handler = _ProbeHandler(probe_path)
+        try:
+            watch = observer.schedule(handler, str(directory),
+                                      recursive=False)
+        except OSError:
+            return False
+        try:
+            with open(probe_path, 'w') as probe_file:
+                probe_file.write('probe')
+            return handler.seen.wait(timeout)
+        finally:
+            observer.unschedule(watch)
+    finally:
+        os.unlink(probe_path)
+
+
+def walk_tree(root):
+    """
+    Yields root and every directory below it, skipping hidden directories
+    (e.g. '.git').
+    """
+    stack = [str(root)]
+    while stack:
+        directory = stack.pop()
+        yield directory
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.name.startswith('.'):
+                        continue
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+        except OSError:
+            continue
+
+
+def _list_polled_files(directory):
+    """
+    Returns {path: (size, mtime)} of the polled files in directory.
+    """
+    files = {}
+    try:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                if not entry.name.endswith(POLLED_SUFFIXES):
+                    continue
+                try:
+                    if not entry.is_file():
+                        continue
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                files[entry.path] = (stat.st_size, stat.st_mtime_ns)
+    except OSError:
+        # e.g. deleted; its files are reported deleted
+        pass
+    return files
+
+
+class PolledWatch:
+    """
+    A root polled by FigurePoller, with the state of its polled files.
+    """
+
+    def __init__(self, root, handler, walk):
+        self.root = root
+        self.handler = handler
+        self._walk = walk
+        # directory -> {path: (size, mtime)} of its polled files
+        self.files = {}
+        # directories holding figures; polled on every pass
+        self.figure_dirs = set()
+        # directories polled on every pass even without figures (replaced,
+        # never mutated, as it is read by the poller's thread)
+        self.requested_dirs = frozenset()
+        self.next_full_scan = time.monotonic() + FULL_SCAN_INTERVAL
+
+    def poll(self, full=False):
+        """
+        Lists the directories holding figures and the requested directories
+        (every directory of the tree if full) and returns the watchdog events of the changes since the last
+        poll.
+        """
+        directories = set(map(str, self._walk())) if full \
+            else self.figure_dirs | self.requested_dirs
+        events = []
+        for directory in directories:
+            events += self._update(directory,
+                                   _list_polled_files(directory))
+        if full:
+            # deleted, or now ignored
+            for directory in set(self.files) - directories:
+                events += self._update(directory, {})
+        return events
+
+    def _update(self, directory, files):
+        previous_files = self.files.get(directory, {})
+        events = []
+        for path, signature in files.items():
+            previous_signature = previous_files.get(path)
+            if previous_signature is None:
+                events.append(FileCreatedEvent(path))
+                events.append(FileModifiedEvent(path))
+            elif previous_signature != signature:
+                events.append(FileModifiedEvent(path))
+        for path in previous_files.keys() - files.keys():
+            events.append(FileDeletedEvent(path))
+
+        if files:
+            self.files[directory] = files
+        else:
+            self.files.pop(directory, None)
+        if any(path.endswith('.svg') for path in files):
+            self.figure_dirs.add(directory)
+        else:
+            self.figure_dirs.discard(directory)
+        return events
+
+
+class FigurePoller:
+    """
+    Polls roots on one background thread. Mirrors the schedule/unschedule
+    interface of watchdog's observers.
+    """
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics if metrics is not None else Metrics()
+        self._watches = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stopped = False
+        self._thread = None
+
+    def schedule(self, handler, root, walk=None):
+        """
+        Polls the directories yielded by walk() (default: walk_tree(root))
+        and dispatches the creation, modification and deletion of figures
+        and markdown documents to handler. Returns the PolledWatch to pass to
+        unschedule. Changes are reported from the time of the call on.
+        """
+        watch = PolledWatch(root, handler,
+                            walk or (lambda: walk_tree(root)))
+        # index the current files without reporting them
+        watch.poll(full=True)
+        with self._lock:
+            self._watches.add(watch)
+            self.metrics.set_gauge('polled_roots', len(self._watches))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True)
+                self._thread.start()
+        return watch
+
+    def unschedule(self, watch):
+        with self._lock:
+            self._watches.discard(watch)
+            self.metrics.set_gauge('polled_roots', len(self._watches))
+
+    def stop(self):
+        with self._lock:
+            self._stopped = True
+            thread, self._thread = self._thread, None
+        self._wake.set()
+        if thread is not None:
+            thread.join()
+
+    def _run(self):
+        interval = POLL_INTERVAL_MIN
+        while True:
+            self._wake.wait(interval)
+            with self._lock:
+                if self._stopped:
+                    return
+                watches = list(self._watches)
+
+            start = time.monotonic()
+            changed = False
+            for watch in watches:
+                full = start >= watch.next_full_scan
+                if full:
+                    watch.next_full_scan = start + FULL_SCAN_INTERVAL
+                try:
+                    events = watch.poll(full)
+                except Exception as e:
+                    log.error("polling %s failed: %s" % (watch.root, e))
+                    continue
+                for event in events:
+                    watch.handler.dispatch(event)
+                changed = changed or bool(events)
+            self.metrics.observe('poll_runtime', time.monotonic() - start)
+
+            # poll often while figures are being edited
+            interval = POLL_INTERVAL_MIN if changed \
+                else min(interval * POLL_BACKOFF, POLL_INTERVAL_MAX)
+            self.metrics.set_gauge('poll_interval', interval)
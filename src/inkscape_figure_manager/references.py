@@ -0,0 +1,66 @@
+"""
+Find the figures a markdown document includes.
+
+Documents are scanned line by line, so long documents are never held in
+memory, and only lines mentioning an exported figure are matched against the
+patterns. Supported syntaxes are:
+
+* inline images:            ![alt](figure.png "optional title")
+* reference definitions:    [id]: figure.png
+* HTML images:              <img src="figure.png">
+"""
+
+import re
+
+EXPORTED_SUFFIX = '.png'
+FIGURE_SUFFIX = '.svg'
+
+_INLINE_PATTERN = re.compile(
+    r"!\[[^\]]*\]\(\s*"
+    r"(?:<([^>]*?)\.png>|([^)\s]*?)\.png)"
+    r"""(?:\s+(?:"[^"]*"|'[^']*'|\([^)]*\)))?\s*\)""")
+_DEFINITION_PATTERN = re.compile(
+    r"^ {0,3}\[[^\]]+\]:\s*(?:<([^>]*?)\.png>|(\S*?)\.png)(?:\s|$)")
+_HTML_PATTERN = re.compile(
+    r"""<img\b[^>]*?\bsrc\s*=\s*(?:"([^"]*?)\.png"|'([^']*?)\.png')""",
+    re.IGNORECASE)
+
+
+def _is_local(target):
+    return target and '://' not in target and not target.startswith('data:')
+
+
+def figure_references_in_lines(lines):
+    """
+    Yields the figures (*.svg paths, as written) included by the markdown
+    lines, in order of appearance and without duplicates.
+    """
+    seen = set()
+    for line in lines:
+        if EXPORTED_SUFFIX not in line:
+            continue
+        matches = []
+        for pattern in (_INLINE_PATTERN, _HTML_PATTERN):
+            matches.extend(pattern.finditer(line))
+        definition = _DEFINITION_PATTERN.match(line)
+        if definition is not None:
+            matches.append(definition)
+        matches.sort(key=lambda match: match.start())
+
+        for match in matches:
+            target = match.group(1) or match.group(2)
+            if not _is_local(target):
+                continue
+            figure = target + FIGURE_SUFFIX
+            if figure not in seen:
+                seen.add(figure)
+                yield figure
+
+
+def find_figure_references(markdown_path):
+    """
+    Returns the figures (*.svg paths, relative to the document) included by
+    the markdown document at markdown_path, in order of appearance.
+    """
+    with open(markdown_path, 'r', errors='replace') as markdown_file:
+        return list(figure_references_in_lines(markdown_file))
@@ -0,0 +1,89 @@
+"""
+Find the files an SVG figure links to.
+
+Figures may link bitmaps (`<image xlink:href="photo.png">`) and other SVGs
+(`<image>` or linked clones, `<use xlink:href="shared.svg#logo">`). Their
+exports change when those assets change, even if the figure itself does not.
+
+Figures are scanned as raw bytes with a regular expression rather than
+parsed: it is much cheaper, and embedded (data URI) images are skipped
+without being copied.
+"""
+
+import os
+import re
+from urllib.parse import unquote, urlparse
+
+_CHUNK_SIZE = 1 << 20
+# longest href attribute found across a chunk boundary
+_OVERLAP = 4096
+_HREF_PATTERN = re.compile(
+    rb"""\b(?:xlink:)?href\s*=\s*"""
+    rb"""(?:"(?!data:|#)([^"]*)"|'(?!data:|#)([^']*)')""")
+
+
+def _asset_path(href, directory):
+    """
+    Returns the absolute path of the local file href points to, or None if
+    it points elsewhere (e.g. a web URL).
+    """
+    href = href.decode(errors='replace').strip()
+    if href.startswith('file:'):
+        href = urlparse(href).path
+    elif re.match(r'[a-zA-Z][a-zA-Z0-9+.-]*:', href):
+        return None
+    path = unquote(href.split('#', 1)[0])
+    if not path:
+        return None
+    return os.path.normpath(os.path.join(directory, path))
+
+
+def find_assets(figure_path):
+    """
+    Returns the sorted absolute paths of the local files the figure at
+    figure_path links to, whether they exist or not.
+    """
+    directory = os.path.dirname(os.path.abspath(figure_path))
+    assets = set()
+    carry = b''
+    with open(figure_path, 'rb') as figure_file:
+        for chunk in iter(lambda: figure_file.read(_CHUNK_SIZE), b''):
+            data = carry + chunk
+            # an href across the boundary is found again with the next chunk
+            for match in _HREF_PATTERN.finditer(data):
+                href = match.group(1)
+                if href is None:
+                    href = match.group(2)
+                asset = _asset_path(href, directory)
+                if asset is not None:
+                    assets.add(asset)
+            carry = data[-_OVERLAP:]
+    assets.discard(os.path.abspath(figure_path))
+    return sorted(assets)
+
+
+def asset_signatures(figure_path):
+    """
+    Returns {path: [size, mtime] or None if missing} of the figure's assets,
+    including the assets of linked SVGs.
+    """
+    signatures = {}
+    pending = [figure_path]
+    while pending:
+        try:
+            assets = find_assets(pending.pop())
+        except OSError:
+            continue
+        for asset in assets:
+            if asset in signatures:
+                continue
+            try:
+                stat = os.stat(asset)
+            except OSError:
+                signatures[asset] = None
+                continue
+            signatures[asset] = [stat.st_size, stat.st_mtime_ns]
+            if asset.endswith('.svg'):
+                pending.append(asset)
+    signatures.pop(os.path.abspath(figure_path), None)
+    return signatures
@@ -0,0 +1,165 @@
+"""
+Hash the part of an SVG that affects how it renders.
+
+Inkscape rewrites view state on every save: attributes of the
+`sodipodi:namedview` element (zoom, `cx`/`cy`, window geometry, current layer,
+...) and a few attributes of the root element. Saving after panning, zooming or
+selecting therefore changes the file without changing a single exported pixel.
+render_hash() hashes a canonical form of the document without that state, so
+such saves can skip the export. The rest of the namedview is hashed: its page
+color and opacity are the export background, and Inkscape 1.2+ keeps the pages
+(`inkscape:page`) in it.
+
+The document is read and parsed in one streaming pass, and finished subtrees
+are discarded as the parser goes, so large figures with embedded images are
+neither read twice nor held in memory as a whole tree. Embedded (base64) image
+data is hashed as it streams by and replaced by its digest before parsing;
+XML parsers handle multi-megabyte attribute values slowly.
+"""
+
+import hashlib
+import xml.etree.ElementTree as ElementTree
+
+SODIPODI_NAMESPACE = 'http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd'
+INKSCAPE_NAMESPACE = 'http://www.inkscape.org/namespaces/inkscape'
+
+# attributes that do not affect rendering, on any element
+VIEW_ONLY_ATTRIBUTES = {
+    f'{{{SODIPODI_NAMESPACE}}}docname',
+    f'{{{INKSCAPE_NAMESPACE}}}version',
+    f'{{{INKSCAPE_NAMESPACE}}}export-filename',
+    f'{{{INKSCAPE_NAMESPACE}}}export-xdpi',
+    f'{{{INKSCAPE_NAMESPACE}}}export-ydpi',
+    # view state kept in sodipodi:namedview
+    f'{{{INKSCAPE_NAMESPACE}}}zoom',
+    f'{{{INKSCAPE_NAMESPACE}}}cx',
+    f'{{{INKSCAPE_NAMESPACE}}}cy',
+    f'{{{INKSCAPE_NAMESPACE}}}rotation',
+    f'{{{INKSCAPE_NAMESPACE}}}document-rotation',
+    f'{{{INKSCAPE_NAMESPACE}}}window-width',
+    f'{{{INKSCAPE_NAMESPACE}}}window-height',
+    f'{{{INKSCAPE_NAMESPACE}}}window-x',
+    f'{{{INKSCAPE_NAMESPACE}}}window-y',
+    f'{{{INKSCAPE_NAMESPACE}}}window-maximized',
+    f'{{{INKSCAPE_NAMESPACE}}}current-layer',
+}
+_CHUNK_SIZE = 1 << 20
+_BASE64_MARKER = b';base64,'
+
+
+def _payload_end(data, position):
+    """
+    Returns the index of the quote closing the attribute value holding base64
+    data at position, or -1 if it is not in data.
+    """
+    ends = [end for end in (data.find(b'"', position),
+                            data.find(b"'", position)) if end != -1]
+    return min(ends, default=-1)
+
+
+def _digest_payloads(chunks):
+    """
+    Yields chunks (bytes) with the data of every base64 data URI replaced by
+    its sha256 hex digest.
+    """
+    payload_digest = None
+    carry = b''
+    for chunk in chunks:
+        data = carry + chunk
+        carry = b''
+        output = []
+        position = 0
+        while position < len(data):
+            if payload_digest is not None:
+                end = _payload_end(data, position)
+                if end == -1:
+                    payload_digest.update(data[position:])
+                    break
+                payload_digest.update(data[position:end])
+                output.append(payload_digest.hexdigest().encode())
+                payload_digest = None
+                position = end
+                continue
+            marker = data.find(_BASE64_MARKER, position)
+            if marker == -1:
+                # keep what may be the start of a marker split across chunks
+                cut = max(position, len(data) - len(_BASE64_MARKER) + 1)
+                output.append(data[position:cut])
+                carry = data[cut:]
+                break
+            payload_start = marker + len(_BASE64_MARKER)
+            output.append(data[position:payload_start])
+            position = payload_start
+            payload_digest = hashlib.sha256()
+        yield b''.join(output)
+    if payload_digest is not None:
+        yield payload_digest.hexdigest().encode()
+    yield carry
+
+
+def _update(digest, marker, *values):
+    # length-prefix every value so different documents cannot collide
+    digest.update(marker)
+    for value in values:
+        encoded = (value or '').encode()
+        digest.update(len(encoded).to_bytes(8, 'big'))
+        digest.update(encoded)
+
+
+def render_hash(path):
+    """
+    Returns a hex digest of the render-relevant content of the SVG at path.
+    Comments, processing instructions and view-only state (see
+    VIEW_ONLY_ATTRIBUTES) are left out. If the file is not well-formed XML,
+    the digest of its raw bytes is returned instead.
+    """
+    canonical_digest = hashlib.sha256()
+    raw_digest = hashlib.sha256()
+    parser = ElementTree.XMLPullParser(events=('start', 'end'))
+    well_formed = True
+
+    def consume(events):
+        for event, element in events:
+            if event == 'start':
+                attributes = sorted(
+                    (name, value) for name, value in element.attrib.items()
+                    if name not in VIEW_ONLY_ATTRIBUTES)
+                _update(canonical_digest, b'<', element.tag)
+                for name, value in attributes:
+                    _update(canonical_digest, b'@', name, value)
+                continue
+
+            # text and the tails of children are complete at the end event
+            _update(canonical_digest, b'"', element.text)
+            for child in element:
+                _update(canonical_digest, b'"', child.tail)
+            _update(canonical_digest, b'>')
+            # free everything but the tail, which is hashed by the parent
+            del element[:]
+            element.attrib.clear()
+            element.text = None
+
+    def read_chunks(svg_file):
+        for chunk in iter(lambda: svg_file.read(_CHUNK_SIZE), b''):
+            raw_digest.update(chunk)
+            yield chunk
+
+    with open(path, 'rb') as svg_file:
+        for chunk in _digest_payloads(read_chunks(svg_file)):
+            if not well_formed:
+                continue
+            try:
+                parser.feed(chunk)
+                consume(parser.read_events())
+            except ElementTree.ParseError:
+                well_formed = False
+    if well_formed:
+        try:
+            parser.close()
+            consume(parser.read_events())
+        except ElementTree.ParseError:
+            well_formed = False
+
+    if not well_formed:
+        return 'raw:' + raw_digest.hexdigest()
+    return canonical_digest.hexdigest()
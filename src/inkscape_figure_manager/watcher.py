@@ -6,46 +6,506 @@ Encapsulate a 3rd party library for OS-agnostic file watching with
 inkscape-figure-manager business logic
 """
 
+import graphlib
 import logging
 import os
 import pathlib
-import subprocess
-import sys
+import threading
+import time
 
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import (FileCreatedEvent, FileModifiedEvent,
+                             FileSystemEventHandler)
 from watchdog.observers import Observer as WatchDogObserver
 
+from inkscape_figure_manager.export_backends import (ExportBackendError,
+                                                     ExportBackends,
+                                                     InkscapeBackend)
+from inkscape_figure_manager.export_config import output_settings
+from inkscape_figure_manager.fileutil import walk_files
+from inkscape_figure_manager.ignore import IgnoreRules, find_git_root
+from inkscape_figure_manager.inkscape_shell import (ExportCancelledError,
+                                                    InkscapeShellPool)
+from inkscape_figure_manager.metrics import Metrics
+from inkscape_figure_manager.png_optimizer import PngOptimizer
+from inkscape_figure_manager.polling import (NETWORK_FILESYSTEMS,
+                                             FigurePoller, PolledWatch,
+                                             mount_of, native_events_work)
+from inkscape_figure_manager.svg_assets import asset_signatures
+from inkscape_figure_manager.svg_canonical import render_hash
+
 logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
 log = logging.getLogger('inkscape-figures')
 
+# type and dpi of the default export profile (see export_config.py)
 EXPORT_EXTENSTION_NO_DOT = "png"
+EXPORT_DPI = 300
+# seconds a figure must go without new events (and without its size or mtime
+# changing) before it is exported
+EXPORT_SETTLE_TIME = 0.25
+# concurrent exports; each may run its own Inkscape process
+EXPORT_WORKERS = os.cpu_count() or 1
+# priorities of queued exports; lower runs first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+# how directories are watched: native events, polling (see polling.py), or
+# polling only where native events do not work
+WATCH_BACKENDS = ('auto', 'native', 'polling')
+
+
+def _stat_signature(path):
+    """
+    Returns the (size, mtime) of the file at path, or None if it does not exist.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+class ExportQueue:
+    """
+    Debounces and schedules figure exports.
+
+    Inkscape fires several modified events per save, and other editors may
+    write a figure in pieces. Each submit re-arms a settle timer for that
+    figure; once the timer expires and the file's size and mtime are unchanged
+    since the last check, the figure is exported exactly once.
+
+    Settled figures are exported by a pool of worker threads. A figure is
+    never exported by two workers at once: if it changes while its export
+    runs, that export is cancelled (killing its Inkscape process) and the
+    figure is exported again once it settles. Figures submitted with
+    interactive priority (saves) go before background work (e.g. figures
+    found stale by reconcile); within a priority, the most recently touched
+    figure goes first. A figure submitted to run after other figures waits
+    while any of them is pending or being exported.
+    """
+
+    def __init__(self, export, settle_time=EXPORT_SETTLE_TIME, metrics=None,
+                 workers=1):
+        """
+        export is a callable taking the figure path, its ExportSpan and a
+        threading.Event set when the export should be cancelled; settle_time
+        is in seconds. metrics records the queue depth and spans. workers is
+        the number of exports run concurrently.
+        """
+        self._export = export
+        self._settle_time = settle_time
+        self.metrics = metrics if metrics is not None else Metrics()
+        # figure path -> [deadline, last seen (size, mtime), first event time,
+        #                 priority, figures to export first]
+        self._pending = {}
+        # figure path -> (cancel event, (size, mtime) when its export started)
+        self._in_flight = {}
+        # monotonic time of the last submit or finished export
+        self.last_activity = time.monotonic()
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._threads = [threading.Thread(target=self._run, daemon=True)
+                         for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def _update_gauges(self):
+        self.metrics.set_gauge('queue_depth', len(self._pending))
+        self.metrics.set_gauge('exports_in_flight', len(self._in_flight))
+
+    @property
+    def idle(self):
+        """
+        True if no export is pending or running.
+        """
+        with self._condition:
+            return not self._pending and not self._in_flight
+
+    def submit(self, figure_path, priority=PRIORITY_INTERACTIVE, after=()):
+        """
+        Requests an export of the figure at figure_path, once the figures in
+        after are exported. Repeated requests within the settle window
+        collapse into one export. A request for a figure whose export is
+        running cancels that export if the figure changed since it started.
+        """
+        figure_path = str(figure_path)
+        with self._condition:
+            self.last_activity = time.monotonic()
+            deadline = self.last_activity + self._settle_time
+            pending = self._pending.get(figure_path)
+            if pending is not None:
+                pending[0] = deadline
+                pending[3] = min(pending[3], priority)
+                pending[4].update(after)
+                self.metrics.increment('events_coalesced')
+            else:
+                self._pending[figure_path] = [deadline,
+                                              _stat_signature(figure_path),
+                                              time.time(), priority,
+                                              set(after)]
+
+            in_flight = self._in_flight.get(figure_path)
+            if in_flight is not None and not in_flight[0].is_set() and \
+                    _stat_signature(figure_path) != in_flight[1]:
+                log.info("figure at %s changed during its export; cancelling"
+                         % figure_path)
+                in_flight[0].set()
+            self._update_gauges()
+            self._condition.notify()
+
+    def stop(self):
+        """
+        Stops the worker threads; pending exports are dropped and running
+        exports cancelled.
+        """
+        with self._condition:
+            self._stopped = True
+            self._pending.clear()
+            for cancel, _ in self._in_flight.values():
+                cancel.set()
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _next_ready(self):
+        """
+        Blocks until a figure that is not being exported has settled and
+        returns its path, the time of its first event and the event
+        cancelling its export; returns None once stopped.
+        """
+        with self._condition:
+            while not self._stopped:
+                now = time.monotonic()
+                ready = None
+                ready_key = None
+                next_deadline = None
+                for figure_path, (deadline, _, _, priority, after) in \
+                        self._pending.items():
+                    if figure_path in self._in_flight:
+                        # serialized after the running export
+                        continue
+                    if any(prerequisite in self._pending or
+                           prerequisite in self._in_flight
+                           for prerequisite in after):
+                        # woken when a prerequisite's export finishes
+                        continue
+                    if deadline > now:
+                        if next_deadline is None or deadline < next_deadline:
+                            next_deadline = deadline
+                        continue
+                    # the latest deadline belongs to the latest event
+                    key = (priority, -deadline)
+                    if ready_key is None or key < ready_key:
+                        ready, ready_key = figure_path, key
+                if ready is None:
+                    self._condition.wait(
+                        None if next_deadline is None else next_deadline - now)
+                    continue
+
+                _, signature, received, priority, after = self._pending[ready]
+                current_signature = _stat_signature(ready)
+                if current_signature is None:
+                    # deleted before it settled; nothing to export
+                    del self._pending[ready]
+                    self._update_gauges()
+                elif current_signature != signature:
+                    # still being written; wait for another settle window
+                    self._pending[ready] = [now + self._settle_time,
+                                            current_signature, received,
+                                            priority, after]
+                else:
+                    del self._pending[ready]
+                    cancel = threading.Event()
+                    self._in_flight[ready] = (cancel, current_signature)
+                    self._update_gauges()
+                    return ready, received, cancel
+            return None
+
+    def _run(self):
+        while True:
+            ready = self._next_ready()
+            if ready is None:
+                return
+            figure_path, received, cancel = ready
+            span = self.metrics.start_span(figure_path, received)
+            span.mark('settled')
+            try:
+                self.metrics.profiled(self._export, figure_path, span, cancel)
+            except Exception as e:
+                log.error("export of %s failed: %s" % (figure_path, e))
+                span.finish('failed', error=str(e))
+            finally:
+                with self._condition:
+                    del self._in_flight[figure_path]
+                    self.last_activity = time.monotonic()
+                    self._update_gauges()
+                    # a newer save of the figure, or figures depending on
+                    # it, may be waiting for this one
+                    self._condition.notify_all()
+
+
+class IndexUpdater:
+    """
+    Applies file changes to a FigureIndex on a worker thread.
+
+    Indexing a figure reads the whole file for its linked assets, which takes
+    long for large figures; done on the observer's thread it would hold up the
+    events of every watched directory. Like exports, updates of a path are
+    debounced: each submit re-arms a settle timer and replaces the update
+    pending for that path.
+    """
+
+    def __init__(self, index, settle_time=EXPORT_SETTLE_TIME):
+        self.index = index
+        self._settle_time = settle_time
+        # path -> [deadline, callable taking the index]
+        self._pending = {}
+        self._running = False
+        self._condition = threading.Condition()
+        self._stopped = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    @property
+    def idle(self):
+        """
+        True if no update is pending or running.
+        """
+        with self._condition:
+            return not self._pending and not self._running
+
+    def submit(self, path, update):
+        """
+        Calls update with the index once path goes without new submits for
+        the settle time.
+        """
+        with self._condition:
+            self._pending[str(path)] = [time.monotonic() + self._settle_time,
+                                        update]
+            self._condition.notify()
+
+    def discard(self, root):
+        """
+        Drops the updates pending for root and the paths below it.
+        """
+        root = pathlib.Path(root)
+        with self._condition:
+            for path in list(self._pending):
+                if pathlib.Path(path).is_relative_to(root):
+                    del self._pending[path]
+
+    def stop(self):
+        """
+        Stops the worker thread; pending updates are dropped (reconcile brings
+        the index up to date on the next start).
+        """
+        with self._condition:
+            self._stopped = True
+            self._pending.clear()
+            self._condition.notify()
+        self._thread.join()
+
+    def _next_ready(self):
+        with self._condition:
+            self._running = False
+            while not self._stopped:
+                now = time.monotonic()
+                if not self._pending:
+                    self._condition.wait()
+                    continue
+                path = min(self._pending, key=lambda p: self._pending[p][0])
+                deadline, update = self._pending[path]
+                if deadline > now:
+                    self._condition.wait(deadline - now)
+                    continue
+                del self._pending[path]
+                self._running = True
+                return path, update
+            return None
+
+    def _run(self):
+        while True:
+            ready = self._next_ready()
+            if ready is None:
+                return
+            path, update = ready
+            try:
+                update(self.index)
+            except Exception as e:
+                log.error("could not index %s: %s" % (path, e))
 
 
 class FigureFileSystemEventHandler(FileSystemEventHandler):
+    def __init__(self, export_queue, index_updater=None,
+                 submit_dependents=None):
+        """
+        export_queue is the ExportQueue exporting modified figures;
+        index_updater is an optional IndexUpdater keeping a FigureIndex up to
+        date with figures and documents. submit_dependents is an optional
+        callable queuing the exports of the figures depending on a changed
+        file (see Watcher.submit_dependents).
+        """
+        super().__init__()
+        self.export_queue = export_queue
+        self.index_updater = index_updater
+        self.submit_dependents = submit_dependents
+
+    def _file_changed(self, path):
+        if self.submit_dependents is None:
+            return
+        try:
+            self.submit_dependents(path)
+        except Exception as e:
+            # must not stop the observer's thread
+            log.error("could not queue the figures depending on %s: %s"
+                      % (path, e))
+
+    def _update_index(self, path):
+        if self.index_updater is None:
+            return
+        if path.endswith('.svg'):
+            self.index_updater.submit(
+                path, lambda index: index.update_figure(path))
+        elif path.endswith('.md'):
+            self.index_updater.submit(
+                path, lambda index: index.update_document(path))
+
+    def _remove_from_index(self, path):
+        if self.index_updater is not None:
+            self.index_updater.submit(path, lambda index: index.remove(path))
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._update_index(event.src_path)
+            self._file_changed(event.src_path)
+
+    def on_deleted(self, event):
+        self._remove_from_index(event.src_path)
+        if not event.is_directory:
+            self._file_changed(event.src_path)
+
+    def on_moved(self, event):
+        self._remove_from_index(event.src_path)
+        if event.is_directory:
+            if self.index_updater is not None:
+                self.index_updater.submit(
+                    event.dest_path,
+                    lambda index: index.index_tree(event.dest_path,
+                                                   record_root=False))
+        else:
+            self._update_index(event.dest_path)
+            # e.g. an asset saved to a temporary file and renamed
+            self._file_changed(event.src_path)
+            self._file_changed(event.dest_path)
+
     def on_modified(self, event):
         """
         Method is scheduled with watchdog observer and will be called whenever
         a node within the observed directories is modified. If the modified
-        node is a figure, export it as a `.png`.
+        node is a figure, export it as a `.png`. Figures linking the modified
+        file are exported again too.
 
         NOTE: Inkscape will actually fire this method twice on save. I think it
               has to do with it updating the actual file with the "buffer".
+              The export queue collapses these into a single export.
         """
         if event.is_directory:
             return
-        if pathlib.Path(event.src_path).suffix != ".svg":
+        self._update_index(event.src_path)
+        if pathlib.Path(event.src_path).suffix == ".svg":
+            log.info("figure at %s modified" % (event.src_path))
+            self.export_queue.submit(event.src_path)
+        self._file_changed(event.src_path)
+
+
+class ScopedFigureEventHandler(FigureFileSystemEventHandler):
+    """
+    Handles events of a scoped watch: every directory that is not ignored is
+    watched on its own (non-recursively), and directories created later are
+    watched as they appear.
+    """
+
+    def __init__(self, export_queue, index_updater, watcher, root, rules):
+        super().__init__(export_queue, index_updater,
+                         watcher.submit_dependents)
+        self.watcher = watcher
+        self.root = root
+        self.rules = rules
+
+    def on_created(self, event):
+        super().on_created(event)
+        if event.is_directory:
+            self._watch_new_dir(event.src_path)
+
+    def on_deleted(self, event):
+        super().on_deleted(event)
+        if event.is_directory:
+            self.watcher.unwatch_scoped_dirs(self.root, event.src_path)
+
+    def on_moved(self, event):
+        super().on_moved(event)
+        if event.is_directory:
+            self.watcher.unwatch_scoped_dirs(self.root, event.src_path)
+            self._watch_new_dir(event.dest_path)
+
+    def _watch_new_dir(self, path):
+        if not pathlib.Path(path).is_relative_to(self.root):
             return
+        if self.rules.is_ignored(path):
+            return
+        self.rules.load_directory(path)
+        directories = list(self.rules.walk(path))
+        self.watcher.watch_scoped_dirs(self.root, self, directories)
+        # files written before the watches were added raised no event (e.g.
+        # `mkdir figures && cp plot.svg figures/`)
+        for directory, file_names in walk_files(path, lambda: directories):
+            for file_name in file_names:
+                if file_name.endswith(('.svg', '.md')):
+                    file_path = os.path.join(directory, file_name)
+                    self.dispatch(FileCreatedEvent(file_path))
+                    self.dispatch(FileModifiedEvent(file_path))
+
 
-        log.info("figure at %s modified" % (event.src_path))
-        Watcher.export_figure(event.src_path, EXPORT_EXTENSTION_NO_DOT)
+def export_path(figure_path):
+    """
+    Returns the path of the PNG exported from the figure at figure_path by
+    the default export profile.
+    """
+    return pathlib.Path(figure_path).with_suffix('.' + EXPORT_EXTENSTION_NO_DOT)
 
 
 class Watcher:
 
-    def __init__(self):
+    def __init__(self, manifest=None, index=None, metrics=None, config=None,
+                 workers=EXPORT_WORKERS, watch_backend='auto'):
+        """
+        manifest is an optional ExportManifest used to skip exports of
+        unchanged figures and to find stale figures. index is an optional
+        FigureIndex kept up to date with the watched directories. metrics is
+        the Metrics recording exports. config is the ExportConfig choosing
+        each figure's export backend and profile. workers is the number of
+        concurrent exports. watch_backend is one of WATCH_BACKENDS.
+        """
+        if watch_backend not in WATCH_BACKENDS:
+            raise ValueError(f"unknown watch backend {watch_backend!r}")
+        self.watch_backend = watch_backend
+        # watched root -> {directory: watchdog ObservedWatch or PolledWatch}
         self.watched = {}
+        self._watched_lock = threading.Lock()
+        self.manifest = manifest
+        self.index = index
+        self.index_updater = IndexUpdater(index) if index is not None \
+            else None
+        self.shell_pool = InkscapeShellPool(size=workers)
+        self.backends = ExportBackends(config, self.shell_pool)
+        self.config = self.backends.config
+        self.metrics = metrics if metrics is not None else Metrics()
+        self.export_queue = ExportQueue(self.export, metrics=self.metrics,
+                                        workers=workers)
+        self.png_optimizer = PngOptimizer(self.metrics)
         self.observer = WatchDogObserver()
         self.observer.start()
+        self.poller = FigurePoller(self.metrics)
+        # mount point -> whether its directories are polled (auto backend)
+        self._polled_mounts = {}
 
     @staticmethod
     def find_git_root(path):
@@ -54,51 +514,310 @@ class Watcher:
         from path passed. If the directory does not contain a git repository,
         returns None
         """
-        # ensure path is Pathlib pure path
-        path = pathlib.Path(path).absolute()
-
-        # search for git repository in parent directories
-        for dir in path.parents:
-            for thing in dir.iterdir():
-                if thing.match('*.git'):
-                    if thing.is_dir():
-                        return dir
-
-        return None
+        return find_git_root(path)
 
     @staticmethod
     def export_figure(figure_path, export_extension):
         """
         Exports the figure at figure_path (*.svg) using the export_extension
         (string). The exported file will have the same name and location.
+        Returns True if the export succeeded.
+        """
+        output_path = pathlib.Path(figure_path).with_suffix(
+            '.' + export_extension)
+        return InkscapeBackend.export_with_process(figure_path, output_path,
+                                                   EXPORT_DPI)
+
+    def export(self, figure_path, span=None, cancel=None):
+        """
+        Exports the figure at figure_path to every output of its export
+        profile, with the backend chosen by the export configuration (see
+        export_backends.py).
+
+        Exports are skipped if the manifest shows the figure's content is
+        unchanged since its last successful export. span is the ExportSpan
+        tracing this export; one is started if not given. Setting cancel (a
+        threading.Event) abandons the export.
+        """
+        if span is None:
+            span = self.metrics.start_span(figure_path)
+        settings = self.config.for_figure(figure_path)
+        outputs = self.config.outputs(figure_path, settings)
+        recorded_settings = output_settings(outputs)
+        output_paths = [output.path for output in outputs]
+        span.details['outputs'] = [str(output_path)
+                                   for output_path in output_paths]
+        content_hash = None
+        if self.manifest is not None:
+            current, content_hash = self.manifest.check(
+                figure_path, recorded_settings, output_paths)
+            if current:
+                log.info("figure at %s unchanged; skipping export"
+                         % figure_path)
+                span.finish('skipped')
+                return
+
+        # taken first, so that the figure or assets changing during the export
+        # are seen as changed later
+        signature = assets = None
+        if self.manifest is not None:
+            stat = os.stat(figure_path)
+            signature = (stat.st_size, stat.st_mtime_ns)
+            if content_hash is None:
+                content_hash = render_hash(figure_path)
+            assets = asset_signatures(figure_path)
+        span.mark('export_started')
+        try:
+            backend = self.backends.export(figure_path, outputs, settings,
+                                           cancel)
+        except ExportCancelledError:
+            span.mark('export_finished')
+            span.finish('cancelled')
+            return
+        except ExportBackendError as e:
+            span.mark('export_finished')
+            log.error("export of %s failed" % figure_path)
+            span.finish('failed', error=str(e))
+            return
+        span.mark('export_finished')
+        self.metrics.increment(f'backend_{backend}')
+
+        if self.manifest is not None:
+            self.manifest.record(figure_path, recorded_settings, output_paths,
+                                 content_hash, assets, signature)
+        span.finish('exported', backend=backend)
+        if settings['optimize']:
+            for output in outputs:
+                if output.type == 'png':
+                    self.png_optimizer.submit(output.path,
+                                              settings['optimize_palette'])
+
+    def export_plan(self, figure_path):
+        """
+        Returns the settings recorded in the manifest for exports of the
+        figure at figure_path and the paths of its outputs.
+        """
+        outputs = self.config.outputs(figure_path)
+        return output_settings(outputs), [output.path for output in outputs]
+
+    def submit_dependents(self, changed_path):
+        """
+        Queues exports of the figures whose rendering depends on the file at
+        changed_path: the figures linking it, then the figures linking those
+        figures or their outputs, and so on. Figures are queued in
+        topological order, each to be exported after the figures whose
+        outputs it links. Needs the figure index.
         """
-        command = [
-            'inkscape',
-            figure_path,
-            '--export-area-page',
-            '--export-dpi', '300',
-            f'--export-type={export_extension}',
-        ]
-        completed_process = subprocess.run(command, check=False)
+        if self.index is None:
+            return
+        changed_path = os.path.normpath(changed_path)
+        # dependent figure -> figures whose exports it waits for
+        prerequisites = {}
+        # (changed file, figure exporting it or None)
+        stack = [(changed_path, None)]
+        if changed_path.endswith('.svg'):
+            # the figure itself was queued by its event
+            stack += [(str(output_path), changed_path) for output_path
+                      in self.export_plan(changed_path)[1]]
+        while stack:
+            path, producer = stack.pop()
+            for figure in self.index.figures_using(path):
+                if figure == changed_path:
+                    continue
+                seen = figure in prerequisites
+                figure_prerequisites = prerequisites.setdefault(figure, set())
+                if producer is not None:
+                    figure_prerequisites.add(producer)
+                if seen:
+                    continue
+                stack.append((figure, None))
+                stack += [(str(output_path), figure) for output_path
+                          in self.export_plan(figure)[1]]
+        if not prerequisites:
+            return
 
-        if completed_process.returncode != 0:
-            msg = f"The inkscape export subprocess exited with non-zero " \
-                  f"return code: {completed_process.returncode}"
-            sys.stderr.write(msg)
+        try:
+            order = list(graphlib.TopologicalSorter(
+                prerequisites).static_order())
+        except graphlib.CycleError as e:
+            log.warning("figures link each other's exports in a cycle (%s); "
+                        "exporting them in any order" % ', '.join(e.args[1]))
+            prerequisites = {figure: () for figure in prerequisites}
+            order = sorted(prerequisites)
+        log.info("%s changed; exporting %d dependent figure(s)"
+                 % (changed_path, len(prerequisites)))
+        for figure in order:
+            if figure in prerequisites:
+                self.export_queue.submit(figure, after=prerequisites[figure])
+        self.metrics.increment('dependents_queued', len(prerequisites))
+
+    def reconcile(self, root, scoped=False):
+        """
+        Queues an export of every figure under root whose output is missing
+        or out of date according to the manifest. Intended to catch figures
+        saved while the daemon was not running. Also brings the figure index
+        of root up to date. If scoped, ignored directories are skipped (see
+        watch).
+        """
+        walk = IgnoreRules(root).walk if scoped else None
+        if self.index is not None:
+            self.index.index_tree(root, walk=walk)
+        if self.manifest is None:
+            return
+        stale_count = 0
+        for figure_path in self.manifest.stale_figures(root, self.export_plan,
+                                                       walk):
+            self.export_queue.submit(figure_path, PRIORITY_BACKGROUND)
+            stale_count += 1
+        log.info("reconciled %s: %d stale figure(s)" % (root, stale_count))
 
-    def watch(self, watch_dir):
+    def needs_polling(self, watch_dir):
+        """
+        Returns True if watch_dir should be polled: always or never, unless
+        the watch backend is 'auto'. Then directories on network and
+        virtual machine file systems are polled, as are directories on mounts
+        where a probe file raises no native event.
+        """
+        if self.watch_backend != 'auto':
+            return self.watch_backend == 'polling'
+        mount = mount_of(watch_dir)
+        if mount is not None and mount[1] in NETWORK_FILESYSTEMS:
+            return True
+        mount_point = str(watch_dir) if mount is None else mount[0]
+        with self._watched_lock:
+            polled = self._polled_mounts.get(mount_point)
+        if polled is None:
+            # a directory we cannot write to is trusted
+            polled = native_events_work(self.observer, watch_dir) is False
+            with self._watched_lock:
+                self._polled_mounts[mount_point] = polled
+        return polled
+
+    def watch(self, watch_dir, scoped=False):
         """
         Watches file system for figures (*.svg files) being written.
         Auto-exports when written.
+
+        A scoped watch skips directories ignored by the project's
+        `.gitignore` files and exclude list (see ignore.py) instead of
+        recursively watching the whole tree.
+
+        Directories without working native events are polled (see
+        needs_polling).
         """
-        handler = FigureFileSystemEventHandler()
-        observed_watch = self.observer.schedule(handler, watch_dir,
-                                                recursive=True)
-        self.watched[watch_dir] = observed_watch
+        polled = self.needs_polling(watch_dir)
+        if not polled and not scoped:
+            handler = FigureFileSystemEventHandler(self.export_queue,
+                                                   self.index_updater,
+                                                   self.submit_dependents)
+            try:
+                observed_watch = self.observer.schedule(
+                    handler, str(watch_dir), recursive=True)
+            except OSError as e:
+                # e.g. out of inotify watches
+                log.warning("cannot watch %s natively (%s); polling"
+                            % (watch_dir, e))
+                polled = True
+            else:
+                with self._watched_lock:
+                    self.watched[watch_dir] = {watch_dir: observed_watch}
+                return
+
+        rules = IgnoreRules(watch_dir) if scoped else None
+        if polled:
+            log.info("polling %s" % watch_dir)
+            handler = FigureFileSystemEventHandler(self.export_queue,
+                                                   self.index_updater,
+                                                   self.submit_dependents)
+            polled_watch = self.poller.schedule(
+                handler, watch_dir, None if rules is None else rules.walk)
+            with self._watched_lock:
+                self.watched[watch_dir] = {watch_dir: polled_watch}
+            return
+
+        handler = ScopedFigureEventHandler(self.export_queue,
+                                           self.index_updater, self,
+                                           watch_dir, rules)
+        with self._watched_lock:
+            self.watched[watch_dir] = {}
+        self.watch_scoped_dirs(watch_dir, handler, rules.walk())
+
+    def watch_scoped_dirs(self, root, handler, directories):
+        """
+        Adds non-recursive watches on directories to the scoped watch of root.
+        """
+        for directory in directories:
+            with self._watched_lock:
+                root_watches = self.watched.get(root)
+                if root_watches is None or directory in root_watches:
+                    continue
+                try:
+                    root_watches[directory] = self.observer.schedule(
+                        handler, str(directory), recursive=False)
+                except OSError as e:
+                    # e.g. removed while walking
+                    log.debug("could not watch %s: %s" % (directory, e))
+
+    def unwatch_scoped_dirs(self, root, removed_dir):
+        """
+        Removes the watches on removed_dir and below from the scoped watch of
+        root.
+        """
+        removed_dir = pathlib.Path(removed_dir)
+        with self._watched_lock:
+            root_watches = self.watched.get(root, {})
+            for directory in list(root_watches):
+                if directory == removed_dir or removed_dir in directory.parents:
+                    self.observer.unschedule(root_watches.pop(directory))
+
+    def poll_every_pass(self, root, directories):
+        """
+        If root is polled, lists directories (below root) on every poll
+        instead of only on full scans, so figures saved there are found even
+        before a full scan sees the directories.
+        """
+        with self._watched_lock:
+            polled_watch = self.watched.get(root, {}).get(root)
+        if isinstance(polled_watch, PolledWatch):
+            polled_watch.requested_dirs = frozenset(map(str, directories))
 
     def unwatch(self, unwatch_dir):
         """
         Stops watching file system for figures.
         """
-        observed_watch = self.watched[unwatch_dir]
-        self.observer.unschedule(observed_watch)
+        with self._watched_lock:
+            observed_watches = self.watched.pop(unwatch_dir)
+            for observed_watch in observed_watches.values():
+                if isinstance(observed_watch, PolledWatch):
+                    self.poller.unschedule(observed_watch)
+                else:
+                    self.observer.unschedule(observed_watch)
+        if self.index is not None:
+            self.index_updater.discard(unwatch_dir)
+            self.index.remove_root(unwatch_dir)
+
+    @property
+    def idle(self):
+        """
+        True if no export, PNG optimization or index update is pending or
+        running.
+        """
+        return self.export_queue.idle and self.png_optimizer.idle and \
+            (self.index_updater is None or self.index_updater.idle)
+
+    def close(self):
+        """
+        Stops watching and exporting, and persists the manifest.
+        """
+        self.observer.stop()
+        self.observer.join()
+        self.poller.stop()
+        self.export_queue.stop()
+        self.png_optimizer.stop()
+        if self.index_updater is not None:
+            self.index_updater.stop()
+        self.backends.close()
+        if self.manifest is not None:
+            self.manifest.save()
+        if self.index is not None:
+            self.index.close()
@@ -1,66 +1,959 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import threading
 import time
-from multiprocessing.connection import Client, Listener
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from inkscape_figure_manager import client
 from inkscape_figure_manager.daemon import Daemon
-from inkscape_figure_manager.watcher import Watcher
+from inkscape_figure_manager.export_config import ExportConfig
+from inkscape_figure_manager.figure_index import INDEX_FILE_NAME, FigureIndex
+from inkscape_figure_manager.fileutil import atomic_write_json, read_json
+from inkscape_figure_manager.ignore import IgnoreRules
+from inkscape_figure_manager.manifest import MANIFEST_FILE_NAME, ExportManifest
+from inkscape_figure_manager.metrics import Metrics
+from inkscape_figure_manager.path_trie import PathTrie
+from inkscape_figure_manager.watcher import EXPORT_WORKERS, Watcher
+
+log = logging.getLogger('inkscape-figures')
+
+WATCHED_DIRS_FILE_NAME = 'watched_dirs.json'
+# longest time (in seconds) between two checks of the idle timeout
+IDLE_CHECK_INTERVAL = 30
+# events buffered per subscriber; a subscriber that falls further behind
+# misses events
+SUBSCRIPTION_QUEUE_SIZE = 1024
+# longest request line (in bytes), e.g. a watch request of many directories
+REQUEST_SIZE_LIMIT = 16 << 20
+# seconds client handlers are given to return once the daemon stops
+CLIENT_CLOSE_TIMEOUT = 5
+# seconds a shard may take to start serving
+SHARD_START_TIMEOUT = 10
+# shortest time (in seconds) between two starts of a shard, so that a shard
+# failing on start does not spin
+SHARD_RESTART_DELAY = 1
+# seconds shards are given to exit before they are killed
+SHARD_STOP_TIMEOUT = 5
+
+
+def _normalized_paths(paths):
+    # clients normalize too; an un-normalized path ('a/../b') would look
+    # covered by the wrong root in the trie
+    return [Path(os.path.abspath(path)) for path in paths]
 
 
 class WatcherDaemon(Daemon):
-    _CONN_ADDRESS = ('localhost', 6969)
-    _CONN_KEY = b'qRFax5Kz@FDCY&Z&'  # we care about security here XD
+    """
+    Watches directories for figure changes and serves clients over a Unix
+    domain socket. See client.py for the protocol.
+    """
+
+    def __init__(self, *args, config_dir=None, trace_path=None,
+                 profile_path=None, socket_path=None, idle_timeout=None,
+                 watch_backend='auto', workers=None, **kwargs):
+        """
+        config_dir is the directory holding the daemon's persistent state
+        (e.g. the export manifest) and the export configuration. Without it,
+        no state is persisted.
+        trace_path is an optional JSON-lines file receiving a record of every
+        export; profile_path opts into profiling exports (see Metrics).
+        socket_path defaults to client.SOCKET_PATH.
+        idle_timeout is the number of seconds without client requests and
+        exports after which the daemon saves its state and exits; the next
+        client starts it again. None (or 0) keeps it running.
+        watch_backend selects native events or polling (see Watcher).
+        workers is the number of concurrent exports (default: one per CPU).
+        """
+        super().__init__(*args, **kwargs)
+        self.config_dir = None if config_dir is None else Path(config_dir)
+        self.socket_path = Path(socket_path or client.SOCKET_PATH)
+        self.trace_path = trace_path
+        self.profile_path = profile_path
+        self.idle_timeout = idle_timeout
+        self.watch_backend = watch_backend
+        self.workers = workers
+        self.manifest_file_name = MANIFEST_FILE_NAME
+        self.metrics = None
+        self.watcher = None
+        # every directory clients asked to watch; its roots are watched
+        self.watch_trie = PathTrie()
+        # requested directories watched in scoped mode (see Watcher.watch)
+        self.scoped_dirs = set()
+        # serializes changes to the watch set
+        self._watch_lock = threading.Lock()
+        # monotonic time of the last client request
+        self._last_request = time.monotonic()
+        # reconciles running in the background
+        self._reconciles = set()
+        # restored roots not watched yet (see _restore_watched_dirs)
+        self._restoring = set()
+        # requested directories ignored by the scoped root covering them, so
+        # watched on their own (see _sync_ignored_dirs)
+        self._ignored_dirs = set()
+        # roots given requested directories to list on every poll (see
+        # _sync_polled_dirs)
+        self._polled_roots = set()
+        # (event queue, watched paths, writer) of every subscribed client
+        self._subscriptions = set()
+        # handler task -> writer of every connected client
+        self._clients = {}
+        self._loop = None
+
+    def _save_watched_dirs(self):
+        """
+        Atomically persists the set of requested directories.
+        """
+        if self.config_dir is None:
+            return
+        atomic_write_json(self.config_dir / WATCHED_DIRS_FILE_NAME, {
+            'dirs': sorted(str(path) for path in self.watch_trie),
+            'scoped': sorted(str(path) for path in self.scoped_dirs),
+        })
+
+    def _restore_watched_dirs(self):
+        """
+        Watches the directories persisted by a previous run, in parallel,
+        pruning the ones that no longer exist. Runs while the daemon already
+        serves clients: the directories are recorded first, so requests see
+        them, and their roots are watched without holding the watch lock.
+        """
+        if self.config_dir is None:
+            return
+        saved = read_json(self.config_dir / WATCHED_DIRS_FILE_NAME,
+                          default={})
+        saved_dirs = saved.get('dirs', [])
+        existing_dirs = [saved_dir for saved_dir in saved_dirs
+                         if Path(saved_dir).is_dir()]
+        with self._watch_lock:
+            # roots requested by clients since the daemon started
+            watched_roots = set(map(Path, self.watch_trie.roots()))
+            for existing_dir in existing_dirs:
+                self.watch_trie.add(existing_dir)
+            self.scoped_dirs |= {Path(scoped_dir)
+                                 for scoped_dir in saved.get('scoped', [])
+                                 if scoped_dir in self.watch_trie}
+            roots = set(map(Path, self.watch_trie.roots()))
+            for demoted_root in watched_roots - roots:
+                self._unwatch_root(demoted_root)
+            self._restoring = roots - watched_roots
+            restoring = list(self._restoring)
+            if len(existing_dirs) != len(saved_dirs):
+                self._save_watched_dirs()
+
+        with ThreadPoolExecutor() as executor:
+            # consume the results so exceptions are raised
+            list(executor.map(self._restore_root, restoring))
+        with self._watch_lock:
+            self._sync_ignored_dirs()
+            self._sync_polled_dirs()
+        print(f"restored {len(restoring)} watched directories")
+
+    def _restore_root(self, root):
+        with self._watch_lock:
+            if root not in self._restoring:
+                # no longer a root (see _drop_root)
+                return
+        self._watch_root(root)
+        with self._watch_lock:
+            self._restoring.discard(root)
+            if self.watch_trie.covered_by(root) != root:
+                # demoted or forgotten while it was being watched
+                self._unwatch_root(root)
+                return
+        self._reconcile_in_background(root)
+
+    def _drop_root(self, root):
+        """
+        Stops watching root, which is no longer a root of the trie.
+        """
+        if root in self._restoring:
+            # _restore_root skips it, or unwatches it once it is watched
+            self._restoring.discard(root)
+        else:
+            self._unwatch_root(root)
+
+    def _reconcile_in_background(self, watched_dir):
+        """
+        Exports figures that were saved while nobody was watching.
+        """
+        thread = threading.Thread(target=self._reconcile,
+                                  args=(watched_dir,), daemon=True)
+        self._reconciles.add(thread)
+        thread.start()
+
+    def _reconcile(self, watched_dir):
+        try:
+            self.watcher.reconcile(watched_dir,
+                                   scoped=watched_dir in self.scoped_dirs)
+        finally:
+            self._reconciles.discard(threading.current_thread())
+
+    def _watch_root(self, root):
+        self.watcher.watch(root, scoped=root in self.scoped_dirs)
+
+    def _unwatch_root(self, root):
+        self.watcher.unwatch(root)
 
     @staticmethod
-    def ensure_watch(path):
+    def _ignored_below(root, directory, rules_cache):
+        """
+        Returns True if the ignore rules of the scoped root ignore directory
+        (below root) or one of its ancestors.
+        """
+        if root not in rules_cache:
+            rules_cache[root] = (IgnoreRules(root), {root})
+        rules, loaded = rules_cache[root]
+        current = root
+        for part in directory.relative_to(root).parts:
+            current = current / part
+            if rules.is_ignored(current):
+                return True
+            if current not in loaded:
+                rules.load_directory(current)
+                loaded.add(current)
+        return False
+
+    def _sync_ignored_dirs(self):
+        """
+        Watches the requested directories that the scoped root covering them
+        ignores (its watch skips them) on their own, and stops watching the
+        ones that no longer need it. Called with the watch lock held.
+        """
+        rules_cache = {}
+        wanted = set()
+        for requested in sorted(map(Path, self.watch_trie),
+                                key=lambda path: len(path.parts)):
+            root = self.watch_trie.covered_by(requested)
+            if root is None or Path(root) == requested or \
+                    Path(root) not in self.scoped_dirs:
+                continue
+            if not wanted.isdisjoint(requested.parents):
+                # watched with an ignored ancestor
+                continue
+            if self._ignored_below(Path(root), requested, rules_cache):
+                wanted.add(requested)
+        for directory in wanted - self._ignored_dirs:
+            self._watch_root(directory)
+            self._reconcile_in_background(directory)
+        for directory in self._ignored_dirs - wanted:
+            self._unwatch_root(directory)
+        self._ignored_dirs = wanted
+
+    def _poll_dirs(self, root, directories):
+        self.watcher.poll_every_pass(root, directories)
+
+    def _sync_polled_dirs(self):
         """
-        Intended to be called by clients. Sends a message to the running
-        watcher daemon instructing it to ensure its watching `path`
+        Gives every root the requested directories below it, which a polled
+        root lists on every poll: a directory just made by `create` would
+        otherwise only be seen by the next full scan. Called with the watch
+        lock held.
         """
-        # this shitty timeout will be good enough
-        timeout_length = 4
-        timeout_start = time.time()
-        while (timeout_start + timeout_length) >= time.time():
+        requested = {}
+        for directory in map(Path, self.watch_trie):
+            root = self.watch_trie.covered_by(directory)
+            if root is None or Path(root) == directory:
+                continue
+            if directory in self._ignored_dirs or \
+                    not self._ignored_dirs.isdisjoint(directory.parents):
+                # polled by its own watch
+                continue
+            requested.setdefault(Path(root), set()).add(directory)
+        for root in requested.keys() | self._polled_roots:
+            self._poll_dirs(root, sorted(requested.get(root, ())))
+        self._polled_roots = set(requested)
+
+    def _watch(self, new_dirs, scoped=False):
+        """
+        Ensures every directory in new_dirs is watched. A directory below a
+        watched root is only recorded; a directory above watched roots
+        replaces them. Other roots' watches are left untouched.
+        """
+        with self._watch_lock:
+            changed = False
+            for new_dir in _normalized_paths(new_dirs):
+                if new_dir in self.watch_trie:
+                    continue
+                promoted, demoted = self.watch_trie.add(new_dir)
+                if scoped:
+                    self.scoped_dirs.add(new_dir)
+                changed = True
+                if promoted:
+                    # watch the new root first so no event is missed
+                    self._watch_root(new_dir)
+                    for old_root in demoted:
+                        self._drop_root(Path(old_root))
+                    self._reconcile_in_background(new_dir)
+            if changed:
+                self._sync_ignored_dirs()
+                self._sync_polled_dirs()
+                self._save_watched_dirs()
+
+    def _unwatch(self, old_dirs):
+        """
+        Forgets every directory in old_dirs. Requested directories below a
+        forgotten root become roots and are watched on their own.
+        """
+        with self._watch_lock:
+            changed = False
+            for old_dir in _normalized_paths(old_dirs):
+                if old_dir not in self.watch_trie:
+                    continue
+                demoted, promoted = self.watch_trie.remove(old_dir)
+                changed = True
+                if demoted:
+                    for new_root in map(Path, promoted):
+                        if new_root in self._ignored_dirs:
+                            # already watched on its own
+                            self._ignored_dirs.discard(new_root)
+                            continue
+                        self._watch_root(new_root)
+                    self._drop_root(old_dir)
+                self.scoped_dirs.discard(old_dir)
+            if changed:
+                self._sync_ignored_dirs()
+                self._sync_polled_dirs()
+                self._save_watched_dirs()
+
+    async def _handle_request(self, request):
+        """
+        Dispatches a client request and returns the response.
+        """
+        command = request.get('command')
+        if command == 'idle':
+            # asked by a supervisor; not a sign of activity itself
+            return {'ok': True, 'idle_time': await self._activity_idle_time()}
+        self._last_request = time.monotonic()
+        self.metrics.increment(f'requests_{command}')
+        if command == 'ping':
+            return {'ok': True}
+        if command == 'stats':
+            return {'ok': True, 'stats': await self._stats()}
+        if command == 'watch':
+            # watching a large tree blocks; keep serving other clients
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._watch, request.get('paths', []),
+                request.get('scoped', False))
+            return {'ok': True}
+        if command == 'unwatch':
+            await asyncio.get_running_loop().run_in_executor(
+                None, self._unwatch, request.get('paths', []))
+            return {'ok': True}
+        if command == 'poll':
+            # sent by a supervisor (see WatcherSupervisor._poll_dirs)
+            self.watcher.poll_every_pass(Path(request['root']),
+                                         request.get('paths', []))
+            return {'ok': True}
+        return {'ok': False, 'error': f"unknown command {command!r}"}
+
+    async def _stats(self):
+        self.metrics.dump_profile()
+        stats = self.metrics.snapshot()
+        stats['gauges']['watched_roots'] = len(self.watcher.watched)
+        stats['gauges']['requested_dirs'] = len(list(self.watch_trie))
+        return stats
+
+    def _publish(self, event):
+        """
+        Metrics listener forwarding export events to the subscribed clients.
+        Called on export threads.
+        """
+        if self._loop is None or not self._subscriptions:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._dispatch, event)
+        except RuntimeError:
+            # the event loop is closed; the daemon is shutting down
+            pass
+
+    def _dispatch(self, event):
+        figure = event['figure']
+        for queue, paths, _ in self._subscriptions:
+            if paths and not any(figure == path or
+                                 figure.startswith(path + os.sep)
+                                 for path in paths):
+                continue
             try:
-                with Client(WatcherDaemon._CONN_ADDRESS,
-                            authkey=WatcherDaemon._CONN_KEY) as conn:
-                    conn.send(path)
-                    break
-            except Exception as e:
-                pass
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                self.metrics.increment('subscription_events_dropped')
+
+    async def _stream_events(self, request, reader, writer):
+        """
+        Answers a subscribe request, then writes every export event of the
+        requested figures (or figures below the requested directories; all
+        figures if none are given) to the client until it disconnects.
+        """
+        paths = tuple(str(path).rstrip(os.sep) or os.sep
+                      for path in request.get('paths', []))
+        self._last_request = time.monotonic()
+        self.metrics.increment('requests_subscribe')
+        queue = asyncio.Queue(SUBSCRIPTION_QUEUE_SIZE)
+        subscription = (queue, paths, writer)
+        self._subscriptions.add(subscription)
+        self.metrics.set_gauge('subscriptions', len(self._subscriptions))
+        # subscribers send nothing more; EOF means they are gone
+        disconnected = asyncio.ensure_future(reader.read())
+        try:
+            writer.write(json.dumps({'ok': True}).encode() + b'\n')
+            await writer.drain()
+            while True:
+                next_event = asyncio.ensure_future(queue.get())
+                await asyncio.wait({next_event, disconnected},
+                                   return_when=asyncio.FIRST_COMPLETED)
+                if not next_event.done():
+                    next_event.cancel()
+                    return
+                writer.write(json.dumps(next_event.result()).encode() + b'\n')
+                await writer.drain()
+        finally:
+            disconnected.cancel()
+            self._subscriptions.discard(subscription)
+            self.metrics.set_gauge('subscriptions', len(self._subscriptions))
+
+    async def _handle_client(self, reader, writer):
+        handler = asyncio.current_task()
+        self._clients[handler] = writer
+        try:
+            while True:
+                try:
+                    line = await reader.readline()
+                except ValueError:
+                    # longer than REQUEST_SIZE_LIMIT; where the next request
+                    # starts is unknown, so the connection is closed
+                    writer.write(json.dumps({
+                        'ok': False,
+                        'error': "request too large",
+                    }).encode() + b'\n')
+                    await writer.drain()
+                    return
+                if not line:
+                    return
+                try:
+                    request = json.loads(line)
+                    if request.get('command') == 'subscribe':
+                        # the connection carries events from now on
+                        break
+                    response = await self._handle_request(request)
+                except Exception as e:
+                    response = {'ok': False, 'error': str(e)}
+                writer.write(json.dumps(response).encode() + b'\n')
+                await writer.drain()
+            await self._stream_events(request, reader, writer)
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+            self._clients.pop(handler, None)
+
+    async def _close_clients(self):
+        """
+        Closes every client connection (subscribers see the end of their
+        stream) and waits for the handlers to return. asyncio.run would cancel
+        them, which asyncio logs as an error before Python 3.12.
+        """
+        for writer in self._clients.values():
+            writer.close()
+        if self._clients:
+            await asyncio.wait(list(self._clients),
+                               timeout=CLIENT_CLOSE_TIMEOUT)
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        # a socket left by a dead daemon would make the bind fail
+        self.socket_path.unlink(missing_ok=True)
+        server = await asyncio.start_unix_server(self._handle_client,
+                                                 path=str(self.socket_path),
+                                                 limit=REQUEST_SIZE_LIMIT)
+        os.chmod(self.socket_path, 0o600)
+        # serve while restoring: watching large sets takes a while
+        threading.Thread(target=self._restore_watched_dirs,
+                         daemon=True).start()
+        async with server:
+            await self._run()
+            server.close()
+            await self._close_clients()
+
+    async def _run(self):
+        """
+        Returns when the daemon should stop: after the idle timeout, if set.
+        """
+        if self.idle_timeout:
+            await self._wait_until_idle()
+        else:
+            await asyncio.get_running_loop().create_future()
+
+    async def _activity_idle_time(self):
+        """
+        Returns the seconds since the last request or export, 0 if exports or
+        reconciles are running.
+        """
+        if self._reconciles or not self.watcher.idle:
+            return 0
+        last_activity = max(self._last_request,
+                            self.watcher.export_queue.last_activity)
+        return time.monotonic() - last_activity
+
+    async def _idle_time(self):
+        """
+        Returns the seconds since the daemon last did anything, 0 if it is
+        busy, restoring its watched directories or clients are subscribed.
+        """
+        if self._subscriptions or self._restoring:
+            return 0
+        return await self._activity_idle_time()
+
+    async def _wait_until_idle(self):
+        """
+        Returns once the daemon was idle for idle_timeout seconds.
+        """
+        while (idle_time := await self._idle_time()) < self.idle_timeout:
+            await asyncio.sleep(min(self.idle_timeout - idle_time,
+                                    IDLE_CHECK_INTERVAL))
+        print(f"idle for {self.idle_timeout}s; shutting down")
+
+    def _shut_down(self):
+        """
+        Saves the daemon's state and stops watching. A later start restores
+        it (see _restore_watched_dirs).
+        """
+        with self._watch_lock:
+            self._save_watched_dirs()
+        if self.watcher is not None:
+            self.watcher.close()
+        self.socket_path.unlink(missing_ok=True)
+        print("daemon stopped")
 
     def work(self):
         """
         `main` function for the daemon.
 
         The daemon acts as a server watching a set of directories and
-        listening for new clients and their messages (which are directories)
+        serving clients' requests (e.g. directories to watch) on a Unix
+        domain socket.
         """
 
-        watcher = Watcher()
-        watched_dirs = []
+        manifest = None
+        index = None
+        if self.config_dir is not None:
+            self.config_dir.mkdir(parents=True, exist_ok=True)
+            manifest = ExportManifest(self.config_dir /
+                                      self.manifest_file_name)
+            index = FigureIndex(self.config_dir / INDEX_FILE_NAME)
+        self.metrics = Metrics(self.trace_path, self.profile_path)
+        self.watcher = Watcher(manifest, index, self.metrics,
+                               ExportConfig(self.config_dir),
+                               workers=self.workers or EXPORT_WORKERS,
+                               watch_backend=self.watch_backend)
+        self.metrics.add_listener(self._publish)
 
         print("daemon launched")
+        asyncio.run(self._serve())
+        # only reached once stopped (see _run); the caller removes the pidfile
+        self._shut_down()
+
+
+def _merge_histograms(histograms):
+    """
+    Merges histogram snapshots (see Histogram.snapshot). Quantiles are bucket
+    upper bounds; the largest is kept.
+    """
+    count = sum(histogram['count'] for histogram in histograms)
+    merged = {
+        'count': count,
+        'mean': None,
+        'max': max(histogram['max'] for histogram in histograms),
+    }
+    if count:
+        merged['mean'] = sum(histogram['mean'] * histogram['count']
+                             for histogram in histograms
+                             if histogram['count']) / count
+    for quantile in ('p50', 'p90', 'p99'):
+        merged[quantile] = max((histogram[quantile]
+                                for histogram in histograms
+                                if histogram[quantile] is not None),
+                               default=None)
+    return merged
+
+
+def merge_stats(snapshots):
+    """
+    Merges metrics snapshots (see Metrics.snapshot) of several processes:
+    counters and gauges are summed, histograms merged.
+    """
+    merged = {'uptime': 0, 'counters': {}, 'gauges': {}, 'histograms': {}}
+    histograms = {}
+    for snapshot in snapshots:
+        merged['uptime'] = max(merged['uptime'], snapshot['uptime'])
+        for kind in ('counters', 'gauges'):
+            for name, value in snapshot[kind].items():
+                merged[kind][name] = merged[kind].get(name, 0) + value
+        for name, histogram in snapshot['histograms'].items():
+            histograms.setdefault(name, []).append(histogram)
+    merged['histograms'] = {name: _merge_histograms(named_histograms)
+                            for name, named_histograms in histograms.items()}
+    return merged
+
+
+class WatcherShard(WatcherDaemon):
+    """
+    A worker process of WatcherSupervisor. Watches the roots the supervisor
+    routes to it, keeps its own export manifest and serves the supervisor on
+    its own socket. Exits once its standard input closes, i.e. when the
+    supervisor stops or dies.
+    """
+
+    def __init__(self, shard, **kwargs):
+        super().__init__(None, **kwargs)
+        self.manifest_file_name = f'manifest.shard{shard}.json'
+
+    def _save_watched_dirs(self):
+        # the supervisor persists the watch set
+        pass
+
+    def _restore_watched_dirs(self):
+        pass
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        closed = loop.create_future()
+        stdin = sys.stdin.fileno()
+
+        def read_stdin():
+            if not os.read(stdin, 4096):
+                loop.remove_reader(stdin)
+                closed.set_result(None)
+
+        loop.add_reader(stdin, read_stdin)
+        await closed
+
+
+class WatcherSupervisor(WatcherDaemon):
+    """
+    Supervisor mode of the daemon. Serves clients like WatcherDaemon, but
+    spreads the watched roots over worker processes (WatcherShard), each with
+    its own observer, export queue and Inkscape processes, so that a burst of
+    saves or a reconcile in one large repository does not delay exports in
+    the others.
+
+    A root always goes to the same shard (by a hash of its path), which keeps
+    the root's manifest entries. A shard that exits is started again and
+    given its roots back; the other shards are not affected.
+    """
+
+    def __init__(self, *args, shards=2, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.shards = shards
+        # shard -> {root routed to it: whether it is watched scoped}
+        self._shard_roots = [{} for _ in range(shards)]
+        # shard -> {root routed to it: requested directories to poll}
+        self._shard_polled = [{} for _ in range(shards)]
+        self._processes = [None] * shards
+        # set while a shard serves requests
+        self._ready = None
+        self._stopping = False
+
+    def _shard_of(self, root):
+        return zlib.crc32(str(root).encode()) % self.shards
+
+    def _shard_socket(self, shard):
+        return self.socket_path.with_name(
+            f'{self.socket_path.name}.shard{shard}')
+
+    def _shard_command(self, shard):
+        command = [sys.executable, '-m',
+                   'inkscape_figure_manager.watcher_daemon',
+                   '--shard', str(shard),
+                   '--socket', str(self._shard_socket(shard)),
+                   '--workers', str(max(1, EXPORT_WORKERS // self.shards)),
+                   '--watch-backend', self.watch_backend]
+        if self.config_dir is not None:
+            command += ['--config-dir', str(self.config_dir)]
+        if self.trace_path:
+            command += ['--trace', self.trace_path]
+        if self.profile_path:
+            command += ['--profile', f'{self.profile_path}.shard{shard}']
+        return command
+
+    async def _shard_request(self, shard, message):
+        """
+        Sends message to shard and returns its response. Raises OSError if the
+        shard cannot be reached.
+        """
+        reader, writer = await asyncio.open_unix_connection(
+            str(self._shard_socket(shard)), limit=REQUEST_SIZE_LIMIT)
+        try:
+            writer.write(json.dumps(message).encode() + b'\n')
+            await writer.drain()
+            response = await reader.readline()
+        finally:
+            writer.close()
+        if not response:
+            raise ConnectionError(f"shard {shard} closed the connection")
+        return json.loads(response)
+
+    async def _route(self, root, message):
+        """
+        Records root as watched or unwatched by its shard, or the
+        directories it polls, and forwards message, a watch, unwatch or poll
+        request for root, to the shard. A shard that is not serving gets its
+        roots once it does.
+        """
+        shard = self._shard_of(root)
+        if message['command'] == 'watch':
+            self._shard_roots[shard][str(root)] = message['scoped']
+        elif message['command'] == 'poll' and message['paths']:
+            self._shard_polled[shard][str(root)] = message['paths']
+        elif message['command'] == 'poll':
+            self._shard_polled[shard].pop(str(root), None)
+        else:
+            self._shard_roots[shard].pop(str(root), None)
+            self._shard_polled[shard].pop(str(root), None)
+        if not self._ready[shard].is_set():
+            return
+        try:
+            await self._shard_request(shard, message)
+        except OSError as e:
+            # the shard exited; it is given its roots when restarted
+            log.warning("could not reach shard %d: %s" % (shard, e))
+
+    def _watch_root(self, root):
+        asyncio.run_coroutine_threadsafe(self._route(root, {
+            'command': 'watch',
+            'paths': [str(root)],
+            'scoped': root in self.scoped_dirs,
+        }), self._loop).result()
+
+    def _unwatch_root(self, root):
+        asyncio.run_coroutine_threadsafe(self._route(root, {
+            'command': 'unwatch',
+            'paths': [str(root)],
+        }), self._loop).result()
+
+    def _poll_dirs(self, root, directories):
+        asyncio.run_coroutine_threadsafe(self._route(root, {
+            'command': 'poll',
+            'root': str(root),
+            'paths': list(map(str, directories)),
+        }), self._loop).result()
+
+    def _reconcile_in_background(self, watched_dir):
+        # shards reconcile the roots they are given
+        pass
+
+    async def _wait_for_shard(self, shard, process):
+        """
+        Returns True once shard answers a ping, False if it exits or does not
+        answer within SHARD_START_TIMEOUT seconds.
+        """
+        deadline = time.monotonic() + SHARD_START_TIMEOUT
+        delay = client.BACKOFF_START
+        while process.returncode is None and time.monotonic() < deadline:
+            try:
+                response = await self._shard_request(shard,
+                                                     {'command': 'ping'})
+                if response.get('ok', False):
+                    return True
+            except OSError:
+                pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, client.BACKOFF_MAX)
+        return False
+
+    async def _forward_events(self, shard):
+        """
+        Subscribes to every export event of shard and passes them on to the
+        supervisor's subscribers.
+        """
+        reader, writer = await asyncio.open_unix_connection(
+            str(self._shard_socket(shard)), limit=REQUEST_SIZE_LIMIT)
+        try:
+            writer.write(json.dumps({'command': 'subscribe'}).encode() + b'\n')
+            await writer.drain()
+            # the response to the subscribe request
+            await reader.readline()
+            while line := await reader.readline():
+                self._dispatch(json.loads(line))
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    async def _supervise_shard(self, shard):
+        """
+        Runs shard, starting it again whenever it exits, until the supervisor
+        stops.
+        """
+        # the shard imports this very package
+        environment = dict(os.environ)
+        environment['PYTHONPATH'] = os.pathsep.join(filter(None, [
+            str(Path(__file__).resolve().parent.parent),
+            environment.get('PYTHONPATH')]))
+        while not self._stopping:
+            started = time.monotonic()
+            process = await asyncio.create_subprocess_exec(
+                *self._shard_command(shard), stdin=asyncio.subprocess.PIPE,
+                env=environment)
+            self._processes[shard] = process
+            forwarder = None
+            try:
+                if await self._wait_for_shard(shard, process):
+                    self._ready[shard].set()
+                    for root, scoped in list(self._shard_roots[shard].items()):
+                        await self._shard_request(shard, {
+                            'command': 'watch',
+                            'paths': [root],
+                            'scoped': scoped,
+                        })
+                    for root, paths in list(self._shard_polled[shard].items()):
+                        await self._shard_request(shard, {
+                            'command': 'poll',
+                            'root': root,
+                            'paths': paths,
+                        })
+                    forwarder = asyncio.ensure_future(
+                        self._forward_events(shard))
+                elif process.returncode is None:
+                    log.error("shard %d did not start serving" % shard)
+                    process.kill()
+                await process.wait()
+            except OSError as e:
+                log.error("shard %d failed: %s" % (shard, e))
+                if process.returncode is None:
+                    process.kill()
+                await process.wait()
+            finally:
+                self._ready[shard].clear()
+                if forwarder is not None:
+                    forwarder.cancel()
+            if self._stopping:
+                return
+            log.warning("shard %d exited with code %s; restarting"
+                        % (shard, process.returncode))
+            self.metrics.increment('shard_restarts')
+            await asyncio.sleep(max(0, started + SHARD_RESTART_DELAY -
+                                    time.monotonic()))
+
+    async def _stop_shards(self, supervisors):
+        self._stopping = True
+        for process in self._processes:
+            if process is not None and process.returncode is None:
+                process.stdin.close()
+        _, pending = await asyncio.wait(supervisors,
+                                        timeout=SHARD_STOP_TIMEOUT)
+        if not pending:
+            return
+        for process in self._processes:
+            if process is not None and process.returncode is None:
+                process.kill()
+        _, pending = await asyncio.wait(pending, timeout=SHARD_STOP_TIMEOUT)
+        for supervisor in pending:
+            supervisor.cancel()
+
+    async def _serve(self):
+        self._loop = asyncio.get_running_loop()
+        self._ready = [asyncio.Event() for _ in range(self.shards)]
+        supervisors = [asyncio.ensure_future(self._supervise_shard(shard))
+                       for shard in range(self.shards)]
+        try:
+            try:
+                await asyncio.wait_for(asyncio.gather(
+                    *(ready.wait() for ready in self._ready)),
+                    SHARD_START_TIMEOUT)
+            except asyncio.TimeoutError:
+                log.warning("not every shard started; they get their roots "
+                            "once they do")
+            await super()._serve()
+        finally:
+            await self._stop_shards(supervisors)
+
+    async def _stats(self):
+        stats = self.metrics.snapshot()
+        shard_stats = []
+        for shard in range(self.shards):
+            process = self._processes[shard]
+            entry = {
+                'shard': shard,
+                'pid': None if process is None else process.pid,
+                'roots': sorted(self._shard_roots[shard]),
+                'stats': None,
+            }
+            if self._ready[shard].is_set():
+                try:
+                    response = await self._shard_request(shard,
+                                                         {'command': 'stats'})
+                    entry['stats'] = response.get('stats')
+                except OSError:
+                    pass
+            shard_stats.append(entry)
+
+        merged = merge_stats([stats] + [entry['stats']
+                                        for entry in shard_stats
+                                        if entry['stats'] is not None])
+        merged['uptime'] = stats['uptime']
+        # every shard counts its own roots as requested, and the supervisor's
+        # event forwarding as a subscription
+        merged['gauges']['requested_dirs'] = len(list(self.watch_trie))
+        merged['gauges']['subscriptions'] = len(self._subscriptions)
+        merged['gauges']['shards_ready'] = sum(ready.is_set()
+                                               for ready in self._ready)
+        merged['shards'] = shard_stats
+        return merged
+
+    async def _activity_idle_time(self):
+        idle_time = time.monotonic() - self._last_request
+        for shard in range(self.shards):
+            if not self._ready[shard].is_set():
+                # (re)starting
+                return 0
+            try:
+                response = await self._shard_request(shard,
+                                                     {'command': 'idle'})
+            except OSError:
+                return 0
+            idle_time = min(idle_time, response.get('idle_time', 0))
+        return idle_time
+
+    def work(self):
+        """
+        `main` function of the supervisor: starts the shards and serves
+        clients on the daemon's socket, routing each watched root to its
+        shard.
+        """
+        if self.config_dir is not None:
+            self.config_dir.mkdir(parents=True, exist_ok=True)
+        self.metrics = Metrics()
+        print(f"supervisor launched with {self.shards} shards")
+        asyncio.run(self._serve())
+        # only reached once stopped (see _run); the caller removes the pidfile
+        self._shut_down()
+
+
+def main(args=None):
+    """
+    Runs a shard of the watcher daemon (see WatcherSupervisor).
+    """
+    parser = argparse.ArgumentParser(description=main.__doc__)
+    parser.add_argument('--shard', type=int, required=True)
+    parser.add_argument('--socket', required=True)
+    parser.add_argument('--config-dir')
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--watch-backend', default='auto')
+    parser.add_argument('--trace')
+    parser.add_argument('--profile')
+    options = parser.parse_args(args)
+    logging.basicConfig(level=os.environ.get("LOGLEVEL", "INFO"))
+    WatcherShard(options.shard, config_dir=options.config_dir,
+                 socket_path=options.socket, trace_path=options.trace,
+                 profile_path=options.profile, workers=options.workers,
+                 watch_backend=options.watch_backend).work()
+
 
-        while True:
-            add_new_dir = True
-            with Listener(WatcherDaemon._CONN_ADDRESS,
-                          authkey=WatcherDaemon._CONN_KEY) as listener:
-                with listener.accept() as conn:
-                    new_dir = Path(conn.recv())
-                    if new_dir not in watched_dirs:
-                        for watched_dir in watched_dirs.copy():
-                            # TODO: consider using PurePath.is_relative_to()
-                            # check if new_dir will be watching existing dir
-                            for parent in watched_dir.parents:
-                                if new_dir == parent:
-                                    watcher.unwatch(watched_dir)
-                                    watched_dirs.remove(watched_dir)
-
-                            # check if existing dir already watches new_dir
-                            for parent in new_dir.parents:
-                                if watched_dir == parent:
-                                    add_new_dir = False
-
-                        if add_new_dir:
-                            watcher.watch(new_dir)
-                            watched_dirs.append(new_dir)
+if __name__ == '__main__':
+    main()